@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Runs the shopping bot on asyncio instead of the thread based Updater of
+python-telegram-bot:
+
+    python async_bot.py [configuration.yaml]
+
+All updates are handled as tasks of one event loop, so many chats are served
+concurrently without a thread per update. Nothing blocks the loop: expenses
+are entered by an AsyncLedgerWriter that writes batches in a dedicated thread,
+households are opened and reports are collected in a thread pool and reports
+are rendered by the report pool.
+
+The Bot API is spoken directly over HTTP with Tornado's asynchronous client.
+Setting bot_api_url in the configuration (e.g. to a fake_telegram.py server)
+lets the bot run without Telegram.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import signal
+import sys
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+import pytz
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+import shoppingbot
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Time zone of the monthly reports and the daily backup
+timezone = pytz.timezone('Europe/Berlin')
+
+class BotAPIError(Exception):
+    pass
+
+class BotAPI:
+    """
+    Minimal asynchronous client of the Telegram Bot API, covering the methods
+    the bot uses.
+    """
+
+    def __init__(self, token, base_url="https://api.telegram.org"):
+        self.url = "{}/bot{}/".format(base_url.rstrip("/"), token)
+        self.client = AsyncHTTPClient()
+
+    async def call(self, method, files=None, request_timeout=30, **parameters):
+        """
+        Calls method with the given parameters (leaving out those that are
+        None) and returns its result. Files are given as a dict mapping field
+        names to (filename, bytes) tuples and are sent as multipart form data.
+        """
+
+        parameters = {name: value for name, value in parameters.items() if value is not None}
+        if files:
+            boundary = uuid.uuid4().hex
+            body = multipart_body(boundary, parameters, files)
+            content_type = "multipart/form-data; boundary=" + boundary
+        else:
+            body = json.dumps(parameters)
+            content_type = "application/json"
+
+        try:
+            response = await self.client.fetch(self.url + method, method="POST", body=body,
+                                               headers={"Content-Type": content_type},
+                                               request_timeout=request_timeout)
+        except HTTPClientError as error:
+            # The Bot API describes errors in the body
+            response = error.response
+            if response is None:
+                raise
+
+        result = json.loads(response.body)
+        if not result.get("ok"):
+            raise BotAPIError("{} failed: {}".format(method, result.get("description")))
+
+        return result["result"]
+
+    async def get_updates(self, offset, timeout=30):
+        return await self.call("getUpdates", request_timeout=timeout + 10, offset=offset, timeout=timeout,
+                               allowed_updates=["message", "callback_query"])
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        return await self.call("sendMessage", chat_id=chat_id, text=text, reply_markup=reply_markup)
+
+    async def edit_message_text(self, chat_id, message_id, text, reply_markup=None):
+        return await self.call("editMessageText", chat_id=chat_id, message_id=message_id, text=text,
+                               reply_markup=reply_markup)
+
+    async def answer_callback_query(self, callback_query_id):
+        return await self.call("answerCallbackQuery", callback_query_id=callback_query_id)
+
+    async def send_document(self, chat_id, filename, data):
+        return await self.call("sendDocument", files={"document": (filename, data)}, chat_id=chat_id)
+
+    async def send_media_group(self, chat_id, media_type, files):
+        """
+        Sends a list of (filename, bytes) files as one album of the given
+        type ("document" or "photo").
+        """
+
+        media = [{"type": media_type, "media": "attach://file{}".format(i)} for i in range(len(files))]
+        return await self.call("sendMediaGroup", files={"file{}".format(i): file for i, file in enumerate(files)},
+                               chat_id=chat_id, media=media)
+
+def multipart_body(boundary, parameters, files):
+    parts = []
+    for name, value in parameters.items():
+        if not isinstance(value, str):
+            value = json.dumps(value)
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n'.format(boundary, name).encode("utf-8")
+                     + value.encode("utf-8") + b"\r\n")
+    for name, (filename, data) in files.items():
+        parts.append('--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n'.format(boundary, name, filename).encode("utf-8")
+                     + data + b"\r\n")
+    parts.append("--{}--\r\n".format(boundary).encode("utf-8"))
+
+    return b"".join(parts)
+
+class AsyncLedgerWriter:
+    """
+    Enters expenses from coroutines into ledgers. A writer task collects
+    everything that was queued while the previous batch was written and
+    enters it with Ledger.enter_many (once per ledger) in a dedicated thread,
+    so the event loop never waits for the disk and a burst of expenses costs
+    one write per ledger.
+    """
+
+    def __init__(self, max_batch=64):
+        self.max_batch = max_batch
+        self.queue = asyncio.Queue()
+        # One thread, so batches are written in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AsyncLedgerWriter")
+        self.task = asyncio.ensure_future(self.__run())
+
+    async def enter(self, ledger, user, value, category="", unixtime=None, recipient="", comment=""):
+        """
+        Enters a purchase into ledger (see Ledger.enter) and returns once it is
+        written. The ledger must stay open until then.
+        """
+
+        entry = {"user": user, "value": value, "category": category, "unixtime": unixtime,
+                 "recipient": recipient, "comment": comment}
+        ledger.check_entry(**entry)
+        written = asyncio.get_running_loop().create_future()
+        await self.queue.put((ledger, entry, written))
+        await written
+
+    @staticmethod
+    def write(batch):
+        """
+        Enters a batch of queued requests and returns the exception raised for
+        each ledger that could not be written.
+        """
+
+        entries = dict()
+        for ledger, entry, _ in batch:
+            entries.setdefault(ledger, []).append(entry)
+
+        errors = dict()
+        for ledger, ledger_entries in entries.items():
+            try:
+                ledger.enter_many(ledger_entries)
+            except Exception as error:
+                errors[ledger] = error
+
+        return errors
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            request = await self.queue.get()
+            if request is None:
+                break
+            batch = [request]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                request = self.queue.get_nowait()
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+
+            errors = await loop.run_in_executor(self.executor, self.write, batch)
+            for ledger, _, written in batch:
+                if written.done():
+                    continue
+                if ledger in errors:
+                    written.set_exception(errors[ledger])
+                else:
+                    written.set_result(None)
+
+    async def close(self):
+        """
+        Writes all queued entries and stops the writer task.
+        """
+
+        # Marks the end of the queue
+        await self.queue.put(None)
+        await self.task
+        self.executor.shutdown()
+
+def next_run(now, hour, minute, last_day_of_month=False):
+    """
+    Returns the next time (after now) at hour:minute in the bot's time zone,
+    only on the last day of a month if last_day_of_month is set.
+    """
+
+    local_now = now.astimezone(timezone)
+    day = local_now.date()
+    while True:
+        run = timezone.localize(datetime.datetime.combine(day, datetime.time(hour, minute)))
+        tomorrow = day + datetime.timedelta(days=1)
+        if run > now and (not last_day_of_month or tomorrow.month != day.month):
+            return run
+        day = tomorrow
+
+class AsyncBot:
+    """
+    Handles the updates of the Bot API with the same behaviour as the
+    handlers in shoppingbot, whose module state (configuration, households,
+    report cache and pool) is set up by shoppingbot.set_up.
+    """
+
+    def __init__(self, api):
+        self.api = api
+        self.households = shoppingbot.households
+        self.writer = AsyncLedgerWriter(shoppingbot.config.get("ledger_group_commit", dict()).get("max_batch", 64))
+        # Collecting report data and exporting run in threads
+        self.executor = ThreadPoolExecutor(thread_name_prefix="AsyncBot")
+        self.user_data = dict()
+        self.tasks = set()
+
+    def __spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.__finished)
+
+    def __finished(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Handling an update failed", exc_info=task.exception())
+
+    async def __in_thread(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    @asynccontextmanager
+    async def use_household(self, name):
+        """
+        Acquires the household name (see Households.use) without blocking the
+        event loop, as opening it loads its ledger.
+        """
+
+        household = await self.__in_thread(self.households.acquire, name)
+        try:
+            yield household
+        finally:
+            await self.__in_thread(self.households.release, household)
+
+    async def enter_expense(self, household, user_data):
+        await self.writer.enter(household.ledger, user_data["user"], user_data["value"], category=user_data["category"],
+                                recipient=user_data["recipient"], comment=user_data["comment"])
+
+    async def handle(self, update):
+        if "callback_query" in update:
+            query = update["callback_query"]
+            name = self.households.find(query["from"]["id"])
+            if name is not None:
+                async with self.use_household(name) as household:
+                    await self.callback_query(household, query)
+            return
+
+        message = update.get("message")
+        if not message or "text" not in message:
+            return
+        chat_id = message["chat"]["id"]
+        text = message["text"]
+        command = text.split()[0].split("@")[0] if text.startswith("/") else None
+
+        if command == "/start":
+            await self.api.send_message(chat_id, shoppingbot.start_text)
+            return
+
+        name = self.households.find(message["from"]["id"])
+        if name is None:
+            await self.api.send_message(chat_id, shoppingbot.not_allowed_text)
+            logger.info("Zugriff wurde untersagt für %s (%s)", message["from"]["id"],
+                        message["from"].get("first_name", ""))
+        elif command == "/help":
+            await self.api.send_message(chat_id, shoppingbot.help_text)
+        elif command == "/stats":
+            await self.api.send_message(chat_id, shoppingbot.stats_text(message["from"]["id"]))
+        elif command in ("/report", "/export", "/balance", None):
+            async with self.use_household(name) as household:
+                if command == "/balance":
+                    # Waits if the balances are still being set up
+                    await self.api.send_message(chat_id, await self.__in_thread(shoppingbot.balance_text, household))
+                elif command == "/report":
+                    await self.report(household, message["from"]["id"])
+                elif command == "/export":
+                    await self.export(household, chat_id, text.split()[1:])
+                else:
+                    await self.text_message(household, message)
+
+    async def text_message(self, household, message):
+        with metrics.histogram("text_message_seconds").time():
+            user_data = self.user_data.setdefault(message["from"]["id"], dict())
+            reply, markup, complete = shoppingbot.read_expense(household, message["text"], user_data)
+            if complete:
+                await self.enter_expense(household, user_data)
+
+            await self.api.send_message(message["chat"]["id"], reply, markup.to_dict() if markup else None)
+
+    async def callback_query(self, household, query):
+        with metrics.histogram("callback_query_seconds").time():
+            await self.api.answer_callback_query(query["id"])
+            user_data = self.user_data.setdefault(query["from"]["id"], dict())
+            message = query["message"]
+            edit, markup, complete = shoppingbot.read_choice(household, query["data"], message.get("text", ""),
+                                                             user_data)
+            if complete:
+                await self.enter_expense(household, user_data)
+
+            await self.api.edit_message_text(message["chat"]["id"], message["message_id"], edit,
+                                             markup.to_dict() if markup else None)
+
+    async def submit_reports(self, household, user):
+        """
+        Collects the data of the reports of user in a thread and returns the
+        futures of the report pool rendering them.
+        """
+
+        return await self.__in_thread(shoppingbot.submit_reports, household, user)
+
+    async def send_reports(self, config, user, futures):
+        """
+        Waits for the report pool to render the reports of user and sends them.
+        """
+
+        reports = await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+        media_type, files = shoppingbot.report_files(config, reports)
+        await self.api.send_media_group(config["users"][user]["telegram_id"], media_type, files)
+
+    async def report(self, household, user_id):
+        for user in shoppingbot.users_of(household, user_id):
+            await self.send_reports(household.config, user, await self.submit_reports(household, user))
+
+    async def household_monthly_report(self, name, opening):
+        # The household is only kept open while the data of the reports is
+        # collected
+        async with opening:
+            async with self.use_household(name) as household:
+                config = household.config
+                futures = await self.__in_thread(shoppingbot.submit_monthly_reports, household)
+
+        await asyncio.gather(*[self.send_reports(config, user, user_futures)
+                               for user, user_futures in futures.items()])
+
+    async def monthly_report(self):
+        # The households are handled concurrently, but never more of them are
+        # opened at once than can be open
+        opening = asyncio.Semaphore(self.households.max_open)
+        names = self.households.names
+        results = await asyncio.gather(*[self.household_monthly_report(name, opening) for name in names],
+                                       return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.error("Monthly report of household %s failed", name, exc_info=result)
+
+    async def export(self, household, chat_id, args):
+        def export_to_bytes():
+            with shoppingbot.exported_file(household, args) as export:
+                return None if export is None else (export[0], export[1].read())
+
+        export = await self.__in_thread(export_to_bytes)
+        if export is None:
+            await self.api.send_message(chat_id, shoppingbot.export_usage_text)
+            return
+
+        await self.api.send_document(chat_id, *export)
+
+    async def run_at(self, next_time, job):
+        """
+        Runs the coroutine function job whenever next_time (a function
+        returning the next time after the given one) says so.
+        """
+
+        while True:
+            now = datetime.datetime.now(pytz.utc)
+            await asyncio.sleep((next_time(now) - now).total_seconds())
+            try:
+                await job()
+            except Exception:
+                logger.exception("Scheduled job %s failed", job.__name__)
+
+    async def backup(self):
+        await self.__in_thread(shoppingbot.rotate_db_backup, None)
+
+    async def poll(self):
+        """
+        Fetches updates with long polling and handles each of them in its own
+        task, so a slow report does not hold up anyone else.
+        """
+
+        offset = None
+        while True:
+            try:
+                updates = await self.api.get_updates(offset)
+            except Exception:
+                logger.exception("Fetching updates failed")
+                await asyncio.sleep(5)
+                continue
+
+            for update in updates:
+                offset = update["update_id"] + 1
+                self.__spawn(self.handle(update))
+
+    async def dump_metrics(self):
+        await self.__in_thread(shoppingbot.dump_metrics, None)
+
+    async def close_idle_households(self):
+        await self.__in_thread(self.households.close_idle)
+
+    async def run(self):
+        config = shoppingbot.config
+        jobs = [
+            # Automatically create a report for every user at the end of each
+            # month and a backup of the ledger each day
+            asyncio.ensure_future(self.run_at(lambda now: next_run(now, 23, 55, last_day_of_month=True),
+                                              self.monthly_report)),
+            asyncio.ensure_future(self.run_at(lambda now: next_run(now, 4, 0), self.backup))
+        ]
+        # Close the ledgers of households that are not used anymore
+        if self.households.max_idle is not None:
+            idle_interval = datetime.timedelta(seconds=min(60, self.households.max_idle))
+            jobs.append(asyncio.ensure_future(self.run_at(lambda now: now + idle_interval,
+                                                          self.close_idle_households)))
+
+        metrics_config = config.get("metrics", dict())
+        if "port" in metrics_config:
+            metrics.serve(metrics_config["port"], metrics_config.get("address", ""))
+        if "file" in metrics_config:
+            interval = datetime.timedelta(seconds=metrics_config.get("interval", 60))
+            jobs.append(asyncio.ensure_future(self.run_at(lambda now: now + interval, self.dump_metrics)))
+
+        if config.get("report_prewarm", True):
+            shoppingbot.report_pool.warm_up()
+
+        try:
+            await self.poll()
+        finally:
+            for job in jobs:
+                job.cancel()
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+            await self.writer.close()
+            self.executor.shutdown()
+
+def main():
+    shoppingbot.set_up(sys.argv[1] if len(sys.argv) > 1 else "configuration.yaml")
+    config = shoppingbot.config
+    api = BotAPI(config["bot_token"], config.get("bot_api_url", "https://api.telegram.org"))
+
+    async def run():
+        # Stop (like Updater.idle) on SIGINT and SIGTERM
+        loop = asyncio.get_running_loop()
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signal_number, asyncio.current_task().cancel)
+        await AsyncBot(api).run()
+
+    try:
+        asyncio.run(run())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    finally:
+        shoppingbot.report_pool.shutdown()
+        shoppingbot.households.close()
+
+if __name__ == '__main__':
+    main()
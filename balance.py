@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Timeframe (both exclusive) containing every transaction
+all_time = (-1, 9999999999)
+
+# Balances below half a cent are considered settled
+tolerance = 0.005
+
+def simplify_debts(positions):
+    """
+    Returns a short list of (debtor, creditor, value) transfers that settle
+    the given net positions (a dict mapping users to what they are owed,
+    negative if they owe something, summing up to zero). The largest debt is
+    always paid to the largest creditor first, so at most one transfer less
+    than there are users with an open balance is needed.
+    """
+
+    creditors = sorted(((value, user) for user, value in positions.items() if value > tolerance), reverse=True)
+    debtors = sorted(((-value, user) for user, value in positions.items() if value < -tolerance), reverse=True)
+
+    transfers = []
+    while creditors and debtors:
+        credit, creditor = creditors.pop(0)
+        debt, debtor = debtors.pop(0)
+        value = min(credit, debt)
+        transfers.append((debtor, creditor, value))
+
+        # Whoever is not settled yet goes back in line
+        if credit - value > tolerance:
+            creditors.append((credit - value, creditor))
+            creditors.sort(reverse=True)
+        if debt - value > tolerance:
+            debtors.append((debt - value, debtor))
+            debtors.sort(reverse=True)
+
+    return transfers
+
+class BalanceEngine:
+    """
+    Keeps track of who owes whom in the ledger of a household.
+
+    Every transaction is money the user paid for the recipient: the user is
+    owed that much and the recipient owes it. Users with a telegram ID take
+    part in the household, everyone else (like "Common") is shared, so what is
+    paid by or for them is split equally among all participants.
+
+    The engine holds the net position of every participant. It is set up once
+    from what every user paid for every recipient in the ledger (in a
+    background thread, as it may still be loading) and then updated with every
+    entry (see Ledger.listen), so asking for the balances never looks at the
+    transactions themselves.
+    """
+
+    def __init__(self, ledger, users):
+        self.participants = [user for user, data in users.items() if "telegram_id" in data]
+        self.positions = dict.fromkeys(self.participants, .0)
+        self.lock = threading.Lock()
+
+        # Entries made while the engine is set up, with the generation of the
+        # ledger after each of them
+        self.pending = []
+        self.generation = None
+        self.loaded = threading.Event()
+        self.loading_error = None
+
+        ledger.listen(self.__entered)
+        self.thread = threading.Thread(target=self.__load, args=(ledger,), name="BalanceEngine", daemon=True)
+        self.thread.start()
+
+    def __shares(self, user):
+        if user in self.positions:
+            return [(user, 1)]
+
+        return [(participant, 1 / len(self.participants)) for participant in self.participants]
+
+    def __add(self, user, value, recipient):
+        for participant, share in self.__shares(user):
+            self.positions[participant] += value * share
+        for participant, share in self.__shares(recipient):
+            self.positions[participant] -= value * share
+
+    def __entered(self, rows, generation):
+        with self.lock:
+            if self.generation is None:
+                self.pending.append((rows, generation))
+                return
+
+            # Listeners are called after the entry was written, so the
+            # snapshot the engine was set up from may already contain it
+            if generation <= self.generation:
+                return
+
+            for row in rows:
+                self.__add(row[0], row[1], row[4])
+
+    def __load(self, ledger):
+        try:
+            with ledger.snapshot() as snapshot:
+                totals = snapshot.group_by(("user", "recipient"), *all_time)
+                generation = snapshot.generation
+
+            with self.lock:
+                for (user, recipient), value in totals.items():
+                    self.__add(user, value, recipient)
+                # Entries made in the meantime that are not in the snapshot
+                for rows, entry_generation in self.pending:
+                    if entry_generation > generation:
+                        for row in rows:
+                            self.__add(row[0], row[1], row[4])
+                self.pending = None
+                self.generation = generation
+        except Exception as error:
+            logger.exception("Setting up the balances of %s failed", ledger.filename)
+            self.loading_error = error
+        finally:
+            self.loaded.set()
+
+    def __wait_until_loaded(self):
+        self.loaded.wait()
+        if self.loading_error is not None:
+            raise RuntimeError("Setting up the balances failed") from self.loading_error
+
+    def balances(self):
+        """
+        Returns the net position of every participant: positive if they are
+        owed money, negative if they owe money.
+        """
+
+        self.__wait_until_loaded()
+        with self.lock:
+            return dict(self.positions)
+
+    def transfers(self):
+        """
+        Returns the (debtor, creditor, value) transfers settling all balances,
+        see simplify_debts.
+        """
+
+        return simplify_debts(self.balances())
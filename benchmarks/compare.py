@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compares two result files of benchmarks/suite.py and lists the change of
+throughput, latency and peak RSS for every operation and ledger size measured
+in both. Exits with status 1 if the p50 or p99 latency of any operation grew
+by more than the threshold.
+
+    python benchmarks/compare.py baseline.json results.json --threshold 10
+"""
+
+import argparse
+import json
+import sys
+
+def change(baseline, current):
+    if baseline == 0:
+        return 0.0
+
+    return (current - baseline) / baseline * 100
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--threshold", type=float, default=10, help="allowed latency increase in percent")
+    args = parser.parse_args()
+
+    results = []
+    for filename in (args.baseline, args.current):
+        with open(filename) as file:
+            results.append({(result["operation"], result["rows"]): result for result in json.load(file)["results"]})
+    baseline, current = results
+
+    regressions = 0
+    print("{:<28} {:>9} {:>10} {:>10} {:>10} {:>10}".format("operation", "rows", "ops/s", "p50", "p99", "RSS"))
+    for key in sorted(baseline.keys() & current.keys()):
+        old, new = baseline[key], current[key]
+        changes = [change(old[metric], new[metric]) for metric in ("throughput", "p50_ms", "p99_ms", "peak_rss_mb")]
+        regressed = changes[1] > args.threshold or changes[2] > args.threshold
+        regressions += regressed
+        print("{:<28} {:>9} {:>+9.1f}% {:>+9.1f}% {:>+9.1f}% {:>+9.1f}%{}".format(
+            key[0], key[1], *changes, "   regression" if regressed else ""))
+
+    for key in sorted(baseline.keys() ^ current.keys()):
+        print("{:<28} {:>9}   only in {}".format(key[0], key[1], args.baseline if key in baseline else args.current))
+
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compares Ledger.calculate_expenses_per_category and
+Ledger.calculate_expenses_per_user on a large synthetic ledger with the plain
+Python loop over row lists the ledger used before it was stored in columns, for
+the whole ledger and for a single month. The columnar ledger keeps every
+transaction in memory, a second copy of it has its years sealed (see
+CSVStorage) and is answered from the summaries of the year partitions.
+
+    python benchmarks/ledger_aggregation.py --rows 1000000
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from ledger import Ledger
+from synthetic import write_synthetic_ledger
+
+users = ["Alice", "Bob", "Common"]
+categories = ["Food", "Books", "Travel", "Other"]
+
+def reference_expenses_per_x(rows, from_time, to_time, recipient, x_index):
+    sums = dict()
+    for row in rows:
+        if row[3] < to_time and row[3] > from_time and row[4] == recipient:
+            sums[row[x_index]] = sums.get(row[x_index], .0) + row[1]
+
+    return list(sums.items())
+
+def best_of(repeat, function, *args):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, "ledger.csv")
+        write_synthetic_ledger(filename, args.rows, users, users[:2], categories, 1500000000, 60)
+        ledger = Ledger(filename, 10**9, seal_years=False)
+        rows = list(ledger.rows())
+        sealed_filename = os.path.join(directory, "sealed.csv")
+        shutil.copyfile(filename, sealed_filename)
+        sealed_ledger = Ledger(sealed_filename, 10**9)
+        windows = {
+            "all time": (0, 9999999999),
+            "one month": (1500000000, 1500000000 + 30 * 24 * 3600)
+        }
+
+        for window, (from_time, to_time) in windows.items():
+            for x, x_index in (("category", 2), ("user", 0)):
+                columnar = best_of(args.repeat, getattr(ledger, "calculate_expenses_per_" + x),
+                                   from_time, to_time, "Common")
+                sealed = best_of(args.repeat, getattr(sealed_ledger, "calculate_expenses_per_" + x),
+                                 from_time, to_time, "Common")
+                reference = best_of(args.repeat, reference_expenses_per_x,
+                                    rows, from_time, to_time, "Common", x_index)
+                print("{:<9} expenses per {:<9} columnar {:9.2f} ms   sealed {:9.2f} ms   python loop {:9.2f} ms   "
+                      "speedup {:8.1f}x".format(window, x, columnar * 1000, sealed * 1000, reference * 1000,
+                                                reference / columnar))
+
+        ledger.close()
+        sealed_ledger.close()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
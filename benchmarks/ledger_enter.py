@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the latency of Ledger.enter for growing ledger sizes, once with the
+append-only journal and once with a compaction after every entry (which is
+what rewriting the whole CSV file on every purchase costs). The synthetic
+transactions are from 2020, so they are only sealed (see CSVStorage) in the
+last case, where compactions rewrite the current year only.
+
+    python benchmarks/ledger_enter.py --sizes 1000 10000 100000 200000
+"""
+
+import argparse
+import csv
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from csv_storage import CSVStorage
+from ledger import Ledger
+
+def write_synthetic_ledger(filename, rows):
+    with open(filename, "w") as file:
+        csv_writer = csv.writer(file, delimiter=CSVStorage.csv_delimiter, quoting=CSVStorage.csv_quoting)
+        for i in range(rows):
+            csv_writer.writerow(["Alice", 9.99, "Food", 1600000000 + i * 60, "Common", "Lidl"])
+
+def measure(directory, rows, entries, compaction_interval, seal_years=False):
+    filename = os.path.join(directory, "ledger_{}_{}.csv".format(rows, "sealed" if seal_years else "unsealed"))
+    write_synthetic_ledger(filename, rows)
+
+    ledger = Ledger(filename, compaction_interval, seal_years=seal_years)
+    latencies = []
+    for i in range(entries):
+        start = time.perf_counter()
+        ledger.enter("Bob", 4.2, category="Books", recipient="Bob", comment="Benchmark")
+        latencies.append(time.perf_counter() - start)
+    ledger.close()
+
+    return statistics.median(latencies), max(latencies)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 200000])
+    parser.add_argument("--entries", type=int, default=100, help="entries timed per ledger size")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:>10} {:>16} {:>16} {:>16} {:>20}".format("rows", "journal p50", "journal max", "rewrite p50",
+                                                          "sealed rewrite p50"))
+        for rows in args.sizes:
+            journal_median, journal_max = measure(directory, rows, args.entries, 10**9)
+            rewrite_median, _ = measure(directory, rows, max(1, args.entries // 10), 1)
+            sealed_median, _ = measure(directory, rows, max(1, args.entries // 10), 1, seal_years=True)
+            print("{:>10} {:>13.3f} ms {:>13.3f} ms {:>13.3f} ms {:>17.3f} ms".format(
+                rows, journal_median * 1000, journal_max * 1000, rewrite_median * 1000, sealed_median * 1000))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
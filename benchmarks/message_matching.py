@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures how long recognizing a category in a message takes with many
+configured synonyms, once with the compiled SynonymMatcher and once with a
+substring search per synonym (as the bot did before).
+
+    python benchmarks/message_matching.py --synonyms 500
+"""
+
+import argparse
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from matcher import SynonymMatcher
+
+def substring_search(categories, message):
+    for category, data in categories.items():
+        if category in message:
+            return category
+        for synonym in data["synonyms"]:
+            if synonym in message:
+                return category
+
+    return ""
+
+def random_word(length):
+    return "".join(random.choice(string.ascii_letters) for _ in range(length))
+
+def measure(function, messages):
+    start = time.perf_counter()
+    for message in messages:
+        function(message)
+
+    return (time.perf_counter() - start) / len(messages)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--synonyms", type=int, default=500, help="synonyms per category")
+    parser.add_argument("--categories", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    random.seed(0)
+    categories = dict()
+    for i in range(args.categories):
+        categories["Category{}".format(i)] = {"synonyms": [random_word(random.randint(4, 12)) for _ in range(args.synonyms)]}
+    all_synonyms = [synonym for data in categories.values() for synonym in data["synonyms"]]
+    messages = ["{:.2f} {} {}".format(random.uniform(1, 100), random_word(8), random.choice(all_synonyms))
+                for _ in range(args.messages)]
+
+    start = time.perf_counter()
+    matcher = SynonymMatcher(categories)
+    compile_time = time.perf_counter() - start
+
+    print("{} categories with {} synonyms each (compiled in {:.1f} ms)".format(
+        args.categories, args.synonyms, compile_time * 1000))
+    print("compiled matcher    {:8.1f} µs per message".format(measure(matcher.find, messages) * 1e6))
+    print("substring search    {:8.1f} µs per message".format(
+        measure(lambda message: substring_search(categories, message), messages) * 1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures how long it takes until the bot could start polling: starting the
+interpreter, importing shoppingbot and running set_up with the example
+configuration and a synthetic ledger. Every run starts a fresh process. Exits
+with status 1 if the median exceeds the target or if Matplotlib was imported
+(it is only needed by the report workers).
+
+    python benchmarks/startup.py --rows 100000 --target 1.0
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repository)
+
+from synthetic import payers, synthetic_config, write_synthetic_ledger
+
+# Runs in the measured process
+measured_program = """
+import json, sys, timeit
+started = timeit.default_timer()
+import shoppingbot
+shoppingbot.set_up(sys.argv[1])
+ready = timeit.default_timer() - started
+shoppingbot.households.close()
+print(json.dumps({"ready": ready, "matplotlib": "matplotlib" in sys.modules}))
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000, help="size of the synthetic ledger")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--target", type=float, default=1.0, help="allowed median startup time in seconds")
+    parser.add_argument("--config", default=os.path.join(repository, "configuration.yaml.example"))
+    args = parser.parse_args()
+
+    config = synthetic_config(args.config)
+    directory = tempfile.mkdtemp()
+    try:
+        config["ledger_file"] = os.path.join(directory, "ledger.csv")
+        duration = 365 * 24 * 3600
+        write_synthetic_ledger(config["ledger_file"], args.rows, list(config["users"]), payers(config),
+                               list(config["categories"]), time.time() - duration, duration / max(1, args.rows))
+        config_file = os.path.join(directory, "configuration.yaml")
+        with open(config_file, "w") as file:
+            yaml.safe_dump(config, file, allow_unicode=True)
+
+        totals = []
+        readies = []
+        matplotlib_imported = False
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", measured_program, config_file], cwd=repository,
+                                    stdout=subprocess.PIPE, check=True).stdout
+            totals.append(time.perf_counter() - start)
+            result = json.loads(output)
+            readies.append(result["ready"])
+            matplotlib_imported |= result["matplotlib"]
+    finally:
+        shutil.rmtree(directory)
+
+    median = statistics.median(totals)
+    print("process start until ready  p50 {:.3f} s  max {:.3f} s".format(median, max(totals)))
+    print("import and set_up          p50 {:.3f} s  max {:.3f} s".format(statistics.median(readies), max(readies)))
+    print("Matplotlib imported: {}".format("yes" if matplotlib_imported else "no"))
+
+    if median > args.target or matplotlib_imported:
+        print("Target of {:.3f} s missed".format(args.target) if median > args.target else
+              "Matplotlib must not be imported at startup")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures the operations the bot spends its time on (entering expenses,
+summarizing the ledger, handling messages and keyboard callbacks and
+generating reports) on synthetic ledgers of different sizes, based on the
+example configuration.
+
+Every operation runs in a fresh process on its own copy of the ledger, so the
+peak RSS reported for it includes loading the ledger but nothing else. For
+every operation and ledger size the throughput and the p50, p99 and maximum
+latency are printed and optionally stored as JSON, which benchmarks/compare.py
+compares with an earlier run. Telegram is replaced by fake objects, so no
+network access or bot token is needed.
+
+The synthetic ledgers end today, so most of their years are closed. They are
+not sealed (see CSVStorage) unless --seal-years is given, which measures the
+operations on the current year in memory and the sealed years on disk.
+
+    python benchmarks/suite.py --rows 1000 100000 1000000 --output results.json
+    python benchmarks/suite.py --rows 10000000 --operations enter expenses_per_category_year
+    python benchmarks/suite.py --rows 1000000 --seal-years
+"""
+
+import argparse
+import datetime
+import glob
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+import yaml
+
+repository = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, repository)
+
+from synthetic import payers, synthetic_config, write_synthetic_ledger
+
+# Operations and how often they are timed by default (per ledger size)
+operations = {
+    "load": 3,
+    "enter": 1000,
+    "expenses_per_category_month": 200,
+    "expenses_per_category_year": 200,
+    "expenses_per_user_year": 200,
+    "text_message": 200,
+    "callback_query": 200,
+    "generate_report": 5
+}
+
+class FakeBot:
+    """
+    Stands in for telegram.Bot and counts what would have been sent.
+    """
+
+    def __init__(self):
+        self.sent = 0
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+
+    def send_document(self, chat_id, document, **kwargs):
+        self.sent += 1
+
+    def send_media_group(self, chat_id, media, **kwargs):
+        self.sent += 1
+
+class FakeMessage:
+    def __init__(self, text=""):
+        self.text = text
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+class FakeCallbackQuery:
+    def __init__(self, data, text):
+        self.data = data
+        self.message = FakeMessage(text)
+
+    def answer(self):
+        pass
+
+    def edit_message_text(self, text, **kwargs):
+        self.message.text = text
+
+class FakeUser:
+    def __init__(self, telegram_id):
+        self.id = telegram_id
+        self.first_name = "Benchmark"
+
+class FakeUpdate:
+    def __init__(self, telegram_id, text=None, callback_data=None):
+        self.effective_user = FakeUser(telegram_id)
+        self.effective_chat = FakeUser(telegram_id)
+        self.message = FakeMessage(text)
+        self.callback_query = FakeCallbackQuery(callback_data, text) if callback_data else None
+
+class FakeContext:
+    def __init__(self, bot):
+        self.bot = bot
+        self.user_data = dict()
+        self.args = []
+
+def percentile(sorted_values, fraction):
+    # Nearest rank
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+def peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def run_operation(operation, config_file, iterations, seed):
+    """
+    Times iterations runs of operation (in this process) and returns the
+    latencies in seconds.
+    """
+
+    import shoppingbot
+    from ledger import Ledger
+    from periods import month_start
+    from report import generate_report
+
+    random_generator = random.Random(seed)
+    shoppingbot.set_up(config_file)
+    household = shoppingbot.households.acquire(shoppingbot.households.names[0])
+    config = household.config
+    ledger = household.ledger
+    users = list(config["users"])
+    categories = list(config["categories"])
+    paying_users = payers(config)
+    telegram_id = config["users"][paying_users[0]]["telegram_id"]
+    bot = FakeBot()
+
+    now = int(time.time())
+    today = datetime.date.today()
+    this_month = month_start(today.year, today.month)
+    this_year = month_start(today.year, 1)
+
+    def load():
+        Ledger(config["ledger_file"], config.get("ledger_compaction_interval", 1000),
+               seal_years=config.get("ledger_seal_years", True)).close()
+
+    def enter():
+        ledger.enter(random_generator.choice(paying_users), round(random_generator.uniform(1, 100), 2),
+                     category=random_generator.choice(categories), recipient=random_generator.choice(users))
+
+    def expenses_per_category_month():
+        ledger.calculate_expenses_per_category(this_month - 1, now, random_generator.choice(users))
+
+    def expenses_per_category_year():
+        ledger.calculate_expenses_per_category(this_year - 1, now, random_generator.choice(users))
+
+    def expenses_per_user_year():
+        ledger.calculate_expenses_per_user(this_year - 1, now, random_generator.choice(users))
+
+    def text_message():
+        # The recipient is always chosen on the keyboard afterwards, so this
+        # only parses the message
+        category = random_generator.choice(categories)
+        keyword = random_generator.choice(config["categories"][category].get("synonyms") or [category])
+        message = "{:.2f} {} {}".format(random_generator.uniform(1, 100), random_generator.choice(paying_users),
+                                        keyword)
+        shoppingbot.text_message(FakeUpdate(telegram_id, message), FakeContext(bot))
+
+    callback_contexts = []
+    def prepare_callback_query():
+        # A message without a category, which is then chosen on the keyboard
+        # and completes the expense
+        context = FakeContext(bot)
+        shoppingbot.text_message(FakeUpdate(telegram_id, "{:.2f} {}".format(
+            random_generator.uniform(1, 100), random_generator.choice(paying_users))), context)
+        context.user_data["recipient"] = random_generator.choice(users)
+        callback_contexts.append(context)
+
+    def callback_query():
+        update = FakeUpdate(telegram_id, "Kategorie?", "category:" + random_generator.choice(categories))
+        shoppingbot.callback_query(update, callback_contexts.pop())
+
+    def report():
+        generate_report("personal", random_generator.choice(paying_users), ledger, config)
+
+    functions = {
+        "load": load,
+        "enter": enter,
+        "expenses_per_category_month": expenses_per_category_month,
+        "expenses_per_category_year": expenses_per_category_year,
+        "expenses_per_user_year": expenses_per_user_year,
+        "text_message": text_message,
+        "callback_query": callback_query,
+        "generate_report": report
+    }
+    function = functions[operation]
+
+    latencies = []
+    try:
+        for _ in range(iterations):
+            if operation == "callback_query":
+                prepare_callback_query()
+            start = time.perf_counter()
+            function()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        shoppingbot.households.release(household)
+        shoppingbot.report_pool.shutdown()
+        shoppingbot.households.close()
+
+    return latencies
+
+def summarize(operation, rows, latencies, peak_rss):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+
+    return {
+        "operation": operation,
+        "rows": rows,
+        "iterations": len(latencies),
+        "throughput": len(latencies) / total if total > 0 else float("inf"),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "peak_rss_mb": peak_rss / 2**20
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=repository, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "platform": platform.platform(),
+        "processors": os.cpu_count()
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="sizes of the synthetic ledgers (up to 10000000)")
+    parser.add_argument("--operations", nargs="+", choices=list(operations), default=list(operations))
+    parser.add_argument("--iterations", type=int, help="timed runs per operation (instead of the defaults)")
+    parser.add_argument("--users", type=int, help="number of users (adding synthetic ones)")
+    parser.add_argument("--categories", type=int, help="number of categories (adding synthetic ones)")
+    parser.add_argument("--years", type=float, default=3, help="years covered by the synthetic ledgers")
+    parser.add_argument("--seal-years", action="store_true", help="seal the closed years of the ledgers")
+    parser.add_argument("--config", default=os.path.join(repository, "configuration.yaml.example"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="JSON file to store the results in")
+    # Used internally to run a single operation in a separate process
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        latencies = run_operation(args.run, args.config, args.iterations, args.seed)
+        json.dump({"latencies": latencies, "peak_rss": peak_rss_bytes()}, sys.stdout)
+        return
+
+    config = synthetic_config(args.config, args.users, args.categories, args.seed)
+    # Reports are rendered in the benchmarking process, the pool stays idle
+    config["report_workers"] = 1
+    config["ledger_seal_years"] = args.seal_years
+    users = list(config["users"])
+    categories = list(config["categories"])
+
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        print("{:<28} {:>9} {:>12} {:>11} {:>11} {:>11} {:>10}".format(
+            "operation", "rows", "ops/s", "p50 ms", "p99 ms", "max ms", "RSS MB"))
+        for rows in args.rows:
+            ledger_file = os.path.join(directory, "synthetic_{}.csv".format(rows))
+            duration = args.years * 365 * 24 * 3600
+            write_synthetic_ledger(ledger_file, rows, users, payers(config), categories,
+                                   time.time() - duration, duration / max(1, rows), args.seed)
+
+            for operation in args.operations:
+                # Every operation gets a fresh copy, as some of them add entries
+                operation_ledger_file = os.path.join(directory, "{}_{}.csv".format(operation, rows))
+                shutil.copyfile(ledger_file, operation_ledger_file)
+                config["ledger_file"] = operation_ledger_file
+                config_file = os.path.join(directory, "configuration.yaml")
+                with open(config_file, "w") as file:
+                    yaml.safe_dump(config, file, allow_unicode=True)
+
+                iterations = args.iterations or operations[operation]
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", operation,
+                                         "--config", config_file, "--iterations", str(iterations),
+                                         "--seed", str(args.seed)],
+                                        cwd=repository, stdout=subprocess.PIPE, check=True).stdout
+                measurement = json.loads(output)
+                result = summarize(operation, rows, measurement["latencies"], measurement["peak_rss"])
+                results.append(result)
+                print("{operation:<28} {rows:>9} {throughput:>12.1f} {p50_ms:>11.3f} {p99_ms:>11.3f} "
+                      "{max_ms:>11.3f} {peak_rss_mb:>10.1f}".format(**result), flush=True)
+
+                for filename in [operation_ledger_file] + glob.glob(glob.escape(operation_ledger_file) + ".*"):
+                    if os.path.exists(filename):
+                        os.remove(filename)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({
+                "environment": environment(),
+                "parameters": {"users": len(users), "categories": len(categories), "years": args.years,
+                               "seal_years": args.seal_years, "seed": args.seed,
+                               "config": os.path.abspath(args.config)},
+                "results": results
+            }, file, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic ledgers and configurations for the benchmarks.
+"""
+
+import copy
+import csv
+import random
+
+import yaml
+
+from csv_storage import CSVStorage
+
+def random_color(random_generator):
+    return "#{:06x}".format(random_generator.randrange(0x1000000))
+
+def synthetic_config(config_file, users=None, categories=None, seed=0):
+    """
+    Loads a configuration (e.g. configuration.yaml.example) and adds synthetic
+    users (with a telegram ID) and categories (with synonyms) until there are
+    at least the given number of each.
+    """
+
+    random_generator = random.Random(seed)
+    with open(config_file) as file:
+        config = copy.deepcopy(yaml.safe_load(file))
+
+    telegram_id = 1000000000
+    while users is not None and len(config["users"]) < users:
+        name = "User{}".format(len(config["users"]))
+        telegram_id += 1
+        config["users"][name] = {"telegram_id": telegram_id, "display_name": name, "emoji_name": "",
+                                 "color": random_color(random_generator), "synonyms": []}
+
+    while categories is not None and len(config["categories"]) < categories:
+        name = "Category{}".format(len(config["categories"]))
+        config["categories"][name] = {"display_name": name, "emoji_name": "",
+                                      "color": random_color(random_generator),
+                                      "synonyms": ["Shop{}".format(len(config["categories"]))]}
+
+    return config
+
+def payers(config):
+    """
+    Returns the users that pay for purchases (everyone with a telegram ID).
+    """
+
+    return [user for user, data in config["users"].items() if "telegram_id" in data]
+
+def write_synthetic_ledger(filename, rows, users, payers, categories, start_time, interval, seed=0):
+    """
+    Writes a CSV ledger file with rows transactions, one every interval
+    seconds from start_time on, paid by random payers for random users.
+    """
+
+    random_generator = random.Random(seed)
+    with open(filename, "w") as file:
+        csv_writer = csv.writer(file, delimiter=CSVStorage.csv_delimiter, quoting=CSVStorage.csv_quoting)
+        for i in range(rows):
+            csv_writer.writerow([random_generator.choice(payers), round(random_generator.uniform(1, 100), 2),
+                                 random_generator.choice(categories), int(start_time + i * interval),
+                                 random_generator.choice(users), ""])
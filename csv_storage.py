@@ -0,0 +1,1268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+import csv
+import datetime
+import gzip
+import io
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import weakref
+import numpy
+from shutil import copyfile
+
+from metrics import metrics
+from periods import month_start, month_of
+
+logger = logging.getLogger(__name__)
+
+class CSVStorage:
+    """
+    Storage backend keeping the whole ledger in memory and persisting it in a
+    CSV file.
+
+    The table is kept in memory column by column: values and times are NumPy
+    arrays and the user, category, recipient and comment columns are stored in
+    StringPools (each distinct string is stored once and rows only hold an
+    integer code). A transaction takes 32 bytes (plus its comment if that is
+    new) and expenses can be summarized with vectorized masks and np.bincount
+    instead of looping over every transaction in Python. Rows are kept ordered
+    by time, which lets every query find its timeframe with a binary search
+    and only look at the transactions inside of it.
+
+    On top of that the ledger maintains monthly totals per recipient, user and
+    category, which are rebuilt when the ledger is loaded and updated with
+    every new entry. Queries spanning whole months are answered from these
+    totals and only the partial months at the start and end of a timeframe
+    are looked up in the transactions, so monthly and yearly reports cost the
+    same no matter how long the ledger has been kept.
+
+    New entries are not written to the CSV file directly but appended (and
+    synced to disk) to a journal file next to it, so entering a purchase costs
+    the same no matter how large the ledger has grown. Every
+    compaction_interval entries (and on startup, after the journal has been
+    replayed) the journal is folded into the CSV file, which is replaced
+    atomically so that a crash never leaves a truncated ledger behind.
+
+    Only one thread at a time writes to the storage, all queries are answered
+    by a CSVSnapshot that is published after every write. Readers therefore
+    never wait for writers (or each other) and never see half of a batch of
+    entries.
+
+    The CSV file is parsed in chunks of load_chunk_size rows, so only one
+    chunk at a time exists as Python objects while loading. With lazy_loading
+    the file is loaded by a background thread: new entries are accepted (and
+    written to the journal) right away, queries wait until the whole ledger
+    is loaded.
+
+    Past years never change, so with seal_years every compaction seals the
+    transactions of closed years into a YearPartition (compressed immutable
+    files with their totals next to the CSV file) and drops them from memory
+    and from the CSV file. A year is closed seal_delay_days days after it
+    ended, so late entries (e.g. a bank statement of December imported in
+    January) can still be made. Only the current year stays in memory and is
+    rewritten by compactions and copied by backups, queries combine the
+    summaries of the partitions with it. Transactions in sealed years can't
+    be entered anymore.
+    """
+
+    column_to_index = {
+        "user": 0,
+        "value": 1,
+        "category": 2,
+        "time": 3,
+        "recipient": 4,
+        "comment": 5
+    }
+
+    # Columns that transactions can be grouped by, stored as integer codes
+    # into a StringPool of names
+    encoded_columns = ("user", "category", "recipient")
+
+    # All columns stored as integer codes into a StringPool
+    pooled_columns = encoded_columns + ("comment",)
+
+    # Keys that transactions can be grouped by besides the encoded columns
+    time_keys = ("month", "year")
+
+    # Keys of the materialized monthly totals, every group_by query can be
+    # derived from them
+    monthly_totals_keys = ("recipient", "month", "user", "category")
+
+    csv_delimiter = " "
+    csv_quoting = csv.QUOTE_NONNUMERIC
+
+    # The first row of every journal file records how many rows the CSV file
+    # contained when the journal was started
+    journal_marker = "journal"
+
+    initial_capacity = 1024
+
+    # Number of rows parsed from the CSV file at once while loading it
+    load_chunk_size = 65536
+
+    def __init__(self, filename, compaction_interval=1000, lazy_loading=False, seal_years=True, seal_delay_days=31):
+        self.filename = filename
+        self.journal_filename = filename + ".journal"
+        self.compaction_interval = compaction_interval
+        self.seal_years = seal_years
+        self.seal_delay_days = seal_delay_days
+        self.journal = None
+        self.journal_entries = 0
+
+        self.size = 0
+        self.values = numpy.empty(self.initial_capacity, dtype=numpy.float64)
+        self.times = numpy.empty(self.initial_capacity, dtype=numpy.int64)
+        self.codes = dict()
+        self.pools = dict()
+        for column in self.pooled_columns:
+            self.codes[column] = numpy.empty(self.initial_capacity, dtype=numpy.int32)
+            self.pools[column] = StringPool()
+        # Nested dicts recipient -> month -> (user, category) -> [sum, count]
+        self.monthly_totals = dict()
+        # Sealed years (also those sealed before seal_years was turned off)
+        # and the first second after them
+        self.partitions = tuple(YearPartition(filename, year) for year in YearPartition.years(filename))
+        self.sealed_until = self.partitions[-1].end if self.partitions else None
+
+        # Held while entries are written, compacted or backed up
+        self.write_lock = threading.RLock()
+        # Held while a snapshot is published or handed out
+        self.state_lock = threading.Lock()
+        # Whether the monthly totals were handed out with a snapshot, and
+        # which of their dicts were copied since then and can be changed in
+        # place (see __monthly_cells)
+        self.monthly_totals_shared = False
+        self.owned_monthly_totals = set()
+        # Snapshots handed out that are still in use
+        self.readers = weakref.WeakSet()
+        self.current = self.__new_snapshot()
+        # Set once the CSV file and the journal are loaded
+        self.loaded = threading.Event()
+        self.loading_error = None
+
+        base_size, journal_rows = self.__read_journal()
+        if lazy_loading and base_size is not None:
+            # New entries are appended to the existing journal while loading,
+            # so it has to end with a complete record
+            self.__rewrite_journal(base_size, journal_rows)
+            thread = threading.Thread(target=self.__load, args=(base_size, journal_rows),
+                                      name="CSVStorage loader", daemon=True)
+            thread.start()
+        else:
+            # Without a journal there is nowhere to put new entries until the
+            # number of rows in the CSV file is known
+            self.__load(base_size, journal_rows)
+            self.__wait_until_loaded()
+
+    def __len__(self):
+        # Does not hand out a snapshot, so nothing has to be copied for it
+        self.__wait_until_loaded()
+        return len(self.current)
+
+    @property
+    def generation(self):
+        self.__wait_until_loaded()
+        return self.current.generation
+
+    def snapshot(self):
+        """
+        Returns a CSVSnapshot of all transactions entered so far (waiting until
+        the ledger is loaded).
+        """
+
+        self.__wait_until_loaded()
+        with self.state_lock:
+            self.monthly_totals_shared = True
+            snapshot = copy.copy(self.current)
+            self.readers.add(snapshot)
+            return snapshot
+
+    def __new_snapshot(self, size=None):
+        # Strings are only ever added to the pools, so the snapshot can share
+        # them as long as it knows how many strings it may see
+        pool_sizes = {column: len(self.pools[column]) for column in self.pooled_columns}
+
+        return CSVSnapshot(self.size if size is None else size, self.values, self.times,
+                           dict(self.codes), self.pools, pool_sizes, self.monthly_totals, self.partitions)
+
+    def __reserve(self, capacity):
+        if capacity <= len(self.values):
+            return
+
+        # numpy.resize returns new arrays, the old ones stay with the
+        # snapshots that reference them
+        capacity = max(capacity, 2 * len(self.values))
+        self.values = numpy.resize(self.values, capacity)
+        self.times = numpy.resize(self.times, capacity)
+        for column in self.pooled_columns:
+            self.codes[column] = numpy.resize(self.codes[column], capacity)
+
+    def __append_rows(self, rows):
+        """
+        Appends rows (lists in the column order of column_to_index) to the
+        columns of the ledger and publishes a new snapshot containing them.
+        """
+
+        values = []
+        times = []
+        codes = {column: [] for column in self.pooled_columns}
+        for row in rows:
+            values.append(row[self.column_to_index["value"]])
+            times.append(row[self.column_to_index["time"]])
+            for column in self.pooled_columns:
+                codes[column].append(self.pools[column].encode(row[self.column_to_index[column]]))
+
+        # Rows behind self.size are not part of any published snapshot, so
+        # they can be written in place
+        start = self.size
+        end = start + len(values)
+        self.__reserve(end)
+        self.values[start:end] = values
+        self.times[start:end] = times
+        for column in self.pooled_columns:
+            self.codes[column][start:end] = codes[column]
+
+        monthly_totals = self.__new_snapshot(end).group(self.monthly_totals_keys, numpy.arange(start, end))
+        self.__restore_time_order(start, end)
+
+        with self.state_lock:
+            if self.monthly_totals_shared:
+                self.owned_monthly_totals = set()
+                self.monthly_totals_shared = False
+
+            for (recipient, month, user, category), (value, count) in monthly_totals.items():
+                cell = self.__monthly_cells(recipient, month).setdefault((user, category), [.0, 0])
+                cell[0] += value
+                cell[1] += count
+
+            self.size = end
+            self.current = self.__new_snapshot()
+
+    def __monthly_cells(self, recipient, month):
+        """
+        Returns the monthly totals of recipient in month for changing them.
+        The dicts on the way to them that are still shared with a snapshot
+        handed out are copied first (once), the totals of all other months
+        stay shared.
+        """
+
+        owned = self.owned_monthly_totals
+        if None not in owned:
+            self.monthly_totals = dict(self.monthly_totals)
+            owned.add(None)
+        if recipient not in owned:
+            self.monthly_totals[recipient] = dict(self.monthly_totals.get(recipient, dict()))
+            owned.add(recipient)
+        months = self.monthly_totals[recipient]
+        if (recipient, month) not in owned:
+            months[month] = {group: list(cell) for group, cell in months.get(month, dict()).items()}
+            owned.add((recipient, month))
+
+        return months[month]
+
+    def __restore_time_order(self, start, end):
+        """
+        Moves the rows from index start up to end to their place in the time
+        ordered columns. Purchases are usually entered in chronological order,
+        in which case nothing has to be done, otherwise only the rows from the
+        earliest back-dated transaction on are reordered.
+
+        Rows a snapshot in use can see must not change, so while there is one
+        the columns are reordered in copies, otherwise in place.
+        """
+
+        if start == end:
+            return
+
+        times = self.times[:end]
+        new_times = times[start:]
+        in_order = numpy.all(new_times[1:] >= new_times[:-1])
+        if in_order and (start == 0 or new_times[0] >= times[start - 1]):
+            return
+
+        first = numpy.searchsorted(times[:start], new_times.min(), side="right")
+        # A stable sort keeps transactions with the same time in the order in
+        # which they were entered
+        order = numpy.argsort(times[first:], kind="stable") + first
+
+        columns = [self.values, self.times] + [self.codes[column] for column in self.pooled_columns]
+        with self.state_lock:
+            # No snapshot can be handed out while the rows are moved
+            if not any(reader.times is self.times and reader.size > first for reader in list(self.readers)):
+                for column in columns:
+                    column[first:end] = column[order]
+                return
+
+        def reorder(column):
+            reordered = numpy.empty_like(column)
+            reordered[:first] = column[:first]
+            reordered[first:end] = column[order]
+            return reordered
+
+        self.values = reorder(self.values)
+        self.times = reorder(self.times)
+        for column in self.pooled_columns:
+            self.codes[column] = reorder(self.codes[column])
+
+    def rows(self, from_time=None, to_time=None, recipient=None):
+        """
+        See CSVSnapshot.rows.
+        """
+
+        return self.snapshot().rows(from_time, to_time, recipient)
+
+    def __read_journal(self):
+        """
+        Returns the number of rows the CSV file had when an existing journal
+        file was started and a list of its complete records. A record torn by
+        a crash while it was written is dropped. Without a valid journal file
+        (None, []) is returned.
+        """
+
+        if not os.path.exists(self.journal_filename):
+            return None, []
+
+        with open(self.journal_filename) as file:
+            content = file.read()
+
+        rows = []
+        try:
+            reader = csv.reader(io.StringIO(content), delimiter=self.csv_delimiter,
+                                quoting=self.csv_quoting, strict=True)
+            for row in reader:
+                rows.append(row)
+        except csv.Error:
+            pass
+        else:
+            # Without a final line terminator the last record was not written
+            # completely
+            if rows and not content.endswith("\n"):
+                rows.pop()
+
+        if not rows or len(rows[0]) != 2 or rows[0][0] != self.journal_marker:
+            return None, []
+
+        records = []
+        for row in rows[1:]:
+            if len(row) != len(self.column_to_index):
+                break
+            records.append(row)
+
+        return int(rows[0][1]), records
+
+    def __rewrite_journal(self, base_size, records):
+        """
+        Atomically replaces the journal file by one containing only the given
+        records and opens it for appending new entries.
+        """
+
+        temporary_filename = self.journal_filename + ".tmp"
+        with open(temporary_filename, "w") as file:
+            csv_writer = csv.writer(file, delimiter=self.csv_delimiter, quoting=self.csv_quoting)
+            csv_writer.writerow([self.journal_marker, base_size])
+            csv_writer.writerows(records)
+            self.__sync(file)
+        os.replace(temporary_filename, self.journal_filename)
+
+        self.journal = open(self.journal_filename, "a")
+        self.journal_entries = len(records)
+
+    def __load(self, base_size, journal_rows):
+        """
+        Loads the CSV file chunk by chunk, replays the records of the journal
+        that are not part of it yet and compacts the ledger if anything was
+        replayed or entered in the meantime (or if there are years to seal).
+        """
+
+        try:
+            # Rows in the CSV file and those of them that were loaded
+            csv_size = 0
+            loaded_size = 0
+            with open(self.filename) as file:
+                reader = csv.reader(file, delimiter=self.csv_delimiter, quoting=self.csv_quoting)
+                while True:
+                    chunk = list(itertools.islice(reader, self.load_chunk_size))
+                    if not chunk:
+                        break
+                    csv_size += len(chunk)
+                    chunk = self.__unsealed(chunk)
+                    # New entries may be appended between two chunks
+                    with self.write_lock:
+                        self.__append_rows(chunk)
+                    loaded_size += len(chunk)
+
+            with self.write_lock:
+                # If the ledger was compacted but the journal was not truncated
+                # afterwards some of the journal records are already in the
+                # CSV file
+                if base_size is not None:
+                    self.__append_rows(self.__unsealed(journal_rows[max(0, csv_size - base_size):]))
+                self.loaded.set()
+
+                if self.size > loaded_size or loaded_size < csv_size or self.__closed_years_size() > 0:
+                    self.compact()
+                elif self.journal is None:
+                    self.__start_journal()
+        except Exception as error:
+            logger.exception("Loading the ledger from %s failed", self.filename)
+            self.loading_error = error
+        finally:
+            self.loaded.set()
+
+    def __unsealed(self, rows):
+        """
+        Returns the rows that are not in a sealed year. Rows in sealed years
+        are only left over in the CSV file and journal if the ledger was not
+        compacted after they were sealed.
+        """
+
+        if self.sealed_until is None:
+            return rows
+
+        time_index = self.column_to_index["time"]
+        return [row for row in rows if row[time_index] >= self.sealed_until]
+
+    def __closed_years_size(self):
+        """
+        Returns the number of rows in memory that are in a closed year (so
+        they are the first rows) and should be sealed.
+        """
+
+        if not self.seal_years:
+            return 0
+
+        open_year = time.localtime(time.time() - self.seal_delay_days * 24 * 3600).tm_year
+        return int(numpy.searchsorted(self.times[:self.size], month_start(open_year, 1), side="left"))
+
+    def __wait_until_loaded(self):
+        self.loaded.wait()
+        if self.loading_error is not None:
+            raise RuntimeError("Loading the ledger from {} failed".format(self.filename)) from self.loading_error
+
+    def __start_journal(self):
+        if self.journal:
+            self.journal.close()
+
+        self.journal = open(self.journal_filename, "w")
+        csv_writer = csv.writer(self.journal, delimiter=self.csv_delimiter, quoting=self.csv_quoting)
+        csv_writer.writerow([self.journal_marker, self.size])
+        self.__sync(self.journal)
+        self.journal_entries = 0
+
+    def __truncate_journal(self, position):
+        try:
+            self.journal.seek(position)
+            self.journal.truncate()
+            self.__sync(self.journal)
+        except OSError:
+            logger.exception("Truncating the journal %s failed", self.journal_filename)
+
+    def __sync(self, file):
+        file.flush()
+        os.fsync(file.fileno())
+
+    def compact(self):
+        """
+        Writes the ledger (except for sealed years) to a temporary file that
+        atomically replaces the CSV file and starts a new, empty journal. With
+        seal_years closed years are sealed afterwards.
+        """
+
+        self.__wait_until_loaded()
+        with self.write_lock:
+            self.__write_csv()
+            self.__start_journal()
+
+            # Sealing drops rows from the CSV file, so it is only done with an
+            # empty journal: records of a journal started before are never
+            # replayed (see __load)
+            if self.__closed_years_size() > 0:
+                self.__seal_closed_years()
+                self.__write_csv()
+                self.__start_journal()
+
+    def __write_csv(self):
+        temporary_filename = self.filename + ".tmp"
+        with open(temporary_filename, "w") as file:
+            csv_writer = csv.writer(file, delimiter=self.csv_delimiter, quoting=self.csv_quoting)
+            csv_writer.writerows(self.current.live_rows())
+            self.__sync(file)
+        os.replace(temporary_filename, self.filename)
+
+    def __seal_closed_years(self):
+        """
+        Seals the rows of all closed years into YearPartitions (one year after
+        another, the oldest first) and drops them from memory.
+        """
+
+        snapshot = self.current
+        sealed_size = self.__closed_years_size()
+        partitions = list(self.partitions)
+        start = 0
+        while start < sealed_size:
+            year = month_of(int(self.times[start]))[0]
+            end = int(numpy.searchsorted(self.times[:sealed_size], month_start(year + 1, 1), side="left"))
+            rows = snapshot.live_rows(month_start(year, 1) - 1, month_start(year + 1, 1))
+            partitions.append(YearPartition.seal(self.filename, year, rows))
+            logger.info("Sealed %d transactions of %d from %s", end - start, year, self.filename)
+            start = end
+
+        # The remaining rows are copied, the old columns stay with the
+        # snapshots that reference them
+        size = self.size - sealed_size
+        capacity = max(self.initial_capacity, 2 * size)
+
+        def drop_sealed(column):
+            remaining = numpy.empty(capacity, dtype=column.dtype)
+            remaining[:size] = column[sealed_size:self.size]
+            return remaining
+
+        with self.state_lock:
+            self.values = drop_sealed(self.values)
+            self.times = drop_sealed(self.times)
+            for column in self.pooled_columns:
+                self.codes[column] = drop_sealed(self.codes[column])
+
+            self.sealed_until = partitions[-1].end
+            sealed_until = month_of(self.sealed_until)
+            # The cells are still shared with the old monthly totals
+            self.monthly_totals = {
+                recipient: {month: cells for month, cells in months.items() if month >= sealed_until}
+                for recipient, months in self.monthly_totals.items()
+            }
+            self.monthly_totals_shared = True
+
+            self.partitions = tuple(partitions)
+            self.size = size
+            self.current = self.__new_snapshot()
+
+    def backup(self, filename):
+        """
+        Writes a complete copy of the ledger to filename. Only the current
+        year is copied every time, sealed years are copied next to the copy
+        once (see YearPartition.copy).
+        """
+
+        # Fold the journal into the CSV file first so that the copy contains
+        # all entries, no entries are written until it is copied
+        self.__wait_until_loaded()
+        with self.write_lock:
+            self.compact()
+            for partition in self.partitions:
+                partition.copy(filename)
+            # A journal copied by backup_files would be replayed on top of it
+            if os.path.exists(filename + ".journal"):
+                os.remove(filename + ".journal")
+            copyfile(self.filename, filename)
+
+    @classmethod
+    def backup_files(cls, filename, backup_filename):
+        """
+        Copies the files of the ledger filename, which is not open, to
+        backup_filename: the CSV file, its journal and its sealed years. The
+        copy is loaded like the ledger itself.
+        """
+
+        for year in YearPartition.years(filename):
+            YearPartition(filename, year).copy(backup_filename)
+        copyfile(filename, backup_filename)
+        journal_filename = filename + ".journal"
+        if os.path.exists(journal_filename):
+            copyfile(journal_filename, backup_filename + ".journal.tmp")
+            os.replace(backup_filename + ".journal.tmp", backup_filename + ".journal")
+        elif os.path.exists(backup_filename + ".journal"):
+            os.remove(backup_filename + ".journal")
+
+    def close(self):
+        self.__wait_until_loaded()
+        with self.write_lock:
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def check(self, rows):
+        """
+        Raises a ValueError if any of the rows can't be entered, because its
+        value or time is not a number or because it is in a sealed year.
+        """
+
+        sealed_until = self.sealed_until
+        for row in rows:
+            try:
+                float(row[self.column_to_index["value"]])
+                unixtime = int(row[self.column_to_index["time"]])
+            except (TypeError, ValueError) as error:
+                raise ValueError("Invalid transaction {}".format(row)) from error
+
+            if sealed_until is not None and unixtime < sealed_until:
+                raise ValueError("Transactions before {} are sealed and can't be entered anymore".format(
+                    time.strftime("%Y-%m-%d", time.localtime(sealed_until))))
+
+    def append(self, rows):
+        """
+        Enters a list of rows (lists in the column order of column_to_index)
+        into the ledger and syncs them to the journal at once. Returns the
+        generation of the ledger including them.
+        """
+
+        with self.write_lock:
+            # Rows only become visible once they are on disk: if writing them
+            # fails, the caller is told so and no query or compaction has
+            # seen them
+            self.check(rows)
+            position = self.journal.tell()
+            try:
+                csv_writer = csv.writer(self.journal, delimiter=self.csv_delimiter, quoting=self.csv_quoting)
+                csv_writer.writerows(rows)
+                self.__sync(self.journal)
+            except Exception:
+                # Whatever reached the journal must not be replayed either
+                self.__truncate_journal(position)
+                raise
+            self.journal_entries += len(rows)
+
+            self.__append_rows(rows)
+
+            # The ledger is compacted anyway once it is loaded
+            if self.journal_entries >= self.compaction_interval and self.loaded.is_set():
+                self.compact()
+
+            return self.current.generation
+
+    def group_by(self, keys, from_time, to_time, recipient=None):
+        """
+        See Ledger.group_by.
+        """
+
+        return self.snapshot().group_by(keys, from_time, to_time, recipient)
+
+class CSVSnapshot:
+    """
+    Read-only view of the transactions in a CSVStorage at one point in time,
+    which answers all queries of the storage.
+
+    A snapshot holds the columns of the storage and the number of rows it had
+    when the snapshot was published. The storage never changes these rows in
+    place while a snapshot handed out can see them: new rows are written
+    behind them, rows are reordered in copies of the columns and the monthly
+    totals of a month are copied before they are updated. So a snapshot can
+    be queried from any thread without locking while new entries are
+    written.
+
+    The sealed years of the storage (its YearPartitions, which never change)
+    come before all of these rows and are part of every query.
+    """
+
+    def __init__(self, size, values, times, codes, pools, pool_sizes, monthly_totals, partitions):
+        self.size = size
+        self.values = values
+        self.times = times
+        self.codes = codes
+        self.pools = pools
+        self.pool_sizes = pool_sizes
+        self.monthly_totals = monthly_totals
+        self.partitions = partitions
+        self.sealed_size = sum(len(partition) for partition in partitions)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def __len__(self):
+        return self.sealed_size + self.size
+
+    @property
+    def generation(self):
+        # The ledger only ever grows (sealing only moves rows), so its size
+        # identifies its content
+        return len(self)
+
+    def rows(self, from_time=None, to_time=None, recipient=None):
+        """
+        Iterates over all transactions (ordered by time) as lists in the column
+        order of CSVStorage.column_to_index, optionally only those between
+        from_time and to_time (both exclusive) and those made for recipient.
+        """
+
+        for partition in self.partitions:
+            yield from partition.rows(from_time, to_time, recipient)
+        yield from self.live_rows(from_time, to_time, recipient)
+
+    def live_rows(self, from_time=None, to_time=None, recipient=None):
+        """
+        Like rows, but only the transactions in memory (not in sealed years).
+        """
+
+        if from_time is None and to_time is None and recipient is None:
+            indices = range(self.size)
+        else:
+            if from_time is None:
+                from_time = numpy.iinfo(numpy.int64).min
+            if to_time is None:
+                to_time = numpy.iinfo(numpy.int64).max
+            if recipient is None:
+                time_range = self.__time_range(from_time, to_time)
+                indices = range(time_range.start, time_range.stop)
+            else:
+                indices = self.__filter_time_and_recipient(from_time, to_time, recipient)
+
+        user_names = self.pools["user"].names
+        category_names = self.pools["category"].names
+        recipient_names = self.pools["recipient"].names
+        comments = self.pools["comment"].names
+        for i in indices:
+            yield [user_names[self.codes["user"][i]],
+                   float(self.values[i]),
+                   category_names[self.codes["category"][i]],
+                   int(self.times[i]),
+                   recipient_names[self.codes["recipient"][i]],
+                   comments[self.codes["comment"][i]]]
+
+    def __time_range(self, from_time, to_time):
+        """
+        Returns the slice of rows with a time between from_time and to_time
+        (both exclusive).
+        """
+
+        times = self.times[:self.size]
+        first = numpy.searchsorted(times, from_time, side="right")
+        last = numpy.searchsorted(times, to_time, side="left")
+
+        return slice(first, max(first, last))
+
+    def __filter_time_and_recipient(self, from_time, to_time, recipient):
+        """
+        Returns the indices of all transactions between from_time and to_time
+        (both exclusive) that were made for recipient.
+        """
+
+        recipient_code = self.pools["recipient"].code(recipient)
+        if recipient_code is None or recipient_code >= self.pool_sizes["recipient"]:
+            return numpy.empty(0, dtype=numpy.intp)
+
+        time_range = self.__time_range(from_time, to_time)
+        mask = self.codes["recipient"][time_range] == recipient_code
+
+        return numpy.flatnonzero(mask) + time_range.start
+
+    def __time_key_codes(self, key, indices):
+        """
+        Returns the (year, month) tuples or years of the transactions at the
+        given indices as integer codes into a list of names.
+        """
+
+        if len(indices) == 0:
+            return numpy.empty(0, dtype=numpy.intp), []
+
+        times = self.times[indices]
+        first_month = month_of(int(times.min()))
+        last_month = month_of(int(times.max()))
+        if key == "year":
+            names = list(range(first_month[0], last_month[0] + 1))
+            boundaries = [month_start(year, 1) for year in names]
+        else:
+            count = (last_month[0] - first_month[0]) * 12 + last_month[1] - first_month[1] + 1
+            boundaries = [month_start(first_month[0], first_month[1] + i) for i in range(count)]
+            names = [month_of(boundary) for boundary in boundaries]
+
+        codes = numpy.searchsorted(numpy.array(boundaries, dtype=numpy.int64), times, side="right") - 1
+
+        return codes, names
+
+    def group(self, keys, indices):
+        """
+        Groups the transactions at the given indices by every combination of
+        keys and returns a dict mapping tuples with one value per key to the
+        [sum, count] of the transactions in that group.
+        """
+
+        # Combine the codes of all keys into one code per transaction, the
+        # first key varying slowest
+        combined_codes = numpy.zeros(len(indices), dtype=numpy.intp)
+        key_names = []
+        for key in keys:
+            if key in CSVStorage.time_keys:
+                codes, names = self.__time_key_codes(key, indices)
+            else:
+                # Only the strings that existed when the snapshot was taken
+                codes, names = self.codes[key][indices], self.pools[key].names[:self.pool_sizes[key]]
+            combined_codes = combined_codes * max(1, len(names)) + codes
+            key_names.append(names)
+
+        return self.sum_groups(combined_codes, key_names, self.values[indices])
+
+    @staticmethod
+    def sum_groups(combined_codes, key_names, values, counts=None):
+        """
+        Sums up values (and counts, one per value if None) by their combined
+        codes of the names of all keys (see group) and returns a dict mapping
+        tuples with one name per key to the [sum, count] of every group.
+        """
+
+        cardinality = 1
+        for names in key_names:
+            cardinality *= len(names)
+        sums = numpy.bincount(combined_codes, weights=values, minlength=cardinality)
+        if counts is None:
+            counts = numpy.bincount(combined_codes, minlength=cardinality)
+        else:
+            counts = numpy.bincount(combined_codes, weights=counts, minlength=cardinality)
+
+        result = dict()
+        for combined_code in numpy.flatnonzero(counts):
+            group = []
+            remainder = combined_code
+            for names in reversed(key_names):
+                remainder, code = divmod(remainder, len(names))
+                group.append(names[code])
+            result[tuple(reversed(group))] = [float(sums[combined_code]), int(counts[combined_code])]
+
+        return result
+
+    def __scan(self, keys, from_time, to_time, recipient):
+        """
+        Groups the transactions between from_time and to_time (both exclusive)
+        by keys, see group.
+        """
+
+        if recipient is None:
+            time_range = self.__time_range(from_time, to_time)
+            indices = numpy.arange(time_range.start, time_range.stop)
+        else:
+            indices = self.__filter_time_and_recipient(from_time, to_time, recipient)
+
+        return self.group(keys, indices)
+
+    def __sum_monthly_totals(self, keys, first_month, end_month, recipient):
+        """
+        Groups the monthly totals of all months from first_month up to (but
+        excluding) end_month by keys, see group.
+        """
+
+        result = dict()
+        if recipient is None:
+            recipients = self.monthly_totals.items()
+        else:
+            recipients = [(recipient, self.monthly_totals.get(recipient, dict()))]
+
+        for recipient, months in recipients:
+            for month, cells in months.items():
+                if month < first_month or month >= end_month:
+                    continue
+                for (user, category), (value, count) in cells.items():
+                    names = {"recipient": recipient, "month": month, "year": month[0],
+                             "user": user, "category": category}
+                    cell = result.setdefault(tuple(names[key] for key in keys), [.0, 0])
+                    cell[0] += value
+                    cell[1] += count
+
+        return result
+
+    @metrics.timed("ledger_group_by_seconds", "Time to summarize expenses (also per category or user)")
+    def group_by(self, keys, from_time, to_time, recipient=None):
+        """
+        See Ledger.group_by.
+        """
+
+        # Whole months between from_time and to_time are taken from the
+        # monthly totals, only the transactions before the first whole month
+        # and after the last whole month are looked at
+        first_month = month_of(from_time)
+        first_month_start = month_start(*first_month)
+        if first_month_start < from_time:
+            first_month_start = month_start(first_month[0], first_month[1] + 1)
+            first_month = month_of(first_month_start)
+        end_month = month_of(to_time)
+        end_month_start = month_start(*end_month)
+
+        if first_month_start >= end_month_start:
+            totals = self.__scan(keys, from_time, to_time, recipient)
+        else:
+            totals = self.__sum_monthly_totals(keys, first_month, end_month, recipient)
+            # Times are whole seconds, so the transactions from the start of
+            # the end month on are those after the second before
+            partial_months = [self.__scan(keys, from_time, first_month_start, recipient),
+                              self.__scan(keys, end_month_start - 1, to_time, recipient)]
+            for partial_month in partial_months:
+                for group, (value, count) in partial_month.items():
+                    cell = totals.setdefault(group, [.0, 0])
+                    cell[0] += value
+                    cell[1] += count
+
+            # Transactions exactly at from_time are outside of the timeframe
+            # but were counted in the monthly totals of the first month
+            if first_month_start == from_time:
+                for group, (value, count) in self.__scan(keys, from_time - 1, from_time + 1, recipient).items():
+                    totals[group][0] -= value
+                    totals[group][1] -= count
+
+        for partition in self.partitions:
+            for group, (value, count) in partition.group_by(keys, from_time, to_time, recipient).items():
+                cell = totals.setdefault(group, [.0, 0])
+                cell[0] += value
+                cell[1] += count
+
+        return {group: value for group, (value, count) in totals.items() if count > 0}
+
+class YearPartition:
+    """
+    Transactions of a closed year, sealed by CSVStorage into three immutable
+    files next to the ledger file: <ledger file>.<year>.csv.gz holds the
+    transactions (ordered by time, compressed day by day),
+    <ledger file>.<year>.columns.npy their times, values, codes and months
+    (one after another, with where the day of each transaction starts in the
+    compressed file) and <ledger file>.<year>.summary.json.gz their number and
+    monthly totals.
+
+    Only the monthly totals and the yearly totals summed up from them are
+    kept in memory, as NumPy arrays of codes into the names of the summary
+    like the columns of CSVStorage. Queries spanning the whole year are
+    answered from the yearly totals and whole months from the monthly totals.
+    For the partial months at the start and end of a timeframe the columns
+    are mapped into memory (and only read by the operating system as far as
+    the query touches them), the transactions themselves are only read when
+    iterating over them.
+    """
+
+    # Keys of the totals that are stored as codes into a list of names
+    encoded_keys = ("recipient", "user", "category")
+
+    # Monthly and yearly totals (with month 0)
+    totals_dtype = numpy.dtype([("month", numpy.int8), ("recipient", numpy.int32), ("user", numpy.int32),
+                                ("category", numpy.int32), ("value", numpy.float64), ("count", numpy.int64)])
+
+    # Columns with one value per transaction, offset is the position of the
+    # day of the transaction in the compressed file. They are stored as one
+    # record with one field per column, so every column is contiguous.
+    column_types = (("time", numpy.int64), ("value", numpy.float64), ("offset", numpy.int64),
+                    ("recipient", numpy.int32), ("user", numpy.int32), ("category", numpy.int32),
+                    ("month", numpy.int8))
+
+    data_suffix = ".csv.gz"
+    columns_suffix = ".columns.npy"
+    summary_suffix = ".summary.json.gz"
+
+    def __init__(self, ledger_filename, year):
+        self.year = year
+        self.filename, self.columns_filename, self.summary_filename = self.filenames(ledger_filename, year)
+        self.start = month_start(year, 1)
+        self.end = month_start(year + 1, 1)
+
+        with gzip.open(self.summary_filename, "rt") as file:
+            summary = json.load(file)
+        self.size = summary["size"]
+        self.names = {key: summary[key] for key in self.encoded_keys}
+        self.recipient_codes = {name: code for code, name in enumerate(self.names["recipient"])}
+        self.monthly_totals = numpy.array([tuple(cell) for cell in summary["monthly_totals"]],
+                                          dtype=self.totals_dtype)
+
+        # One cell per combination of recipient, user and category
+        _, first, inverse = numpy.unique(self.combined_codes(self.monthly_totals, self.encoded_keys),
+                                         return_index=True, return_inverse=True)
+        self.yearly_totals = self.monthly_totals[first]
+        self.yearly_totals["month"] = 0
+        self.yearly_totals["value"] = numpy.bincount(inverse, weights=self.monthly_totals["value"])
+        self.yearly_totals["count"] = numpy.bincount(inverse, weights=self.monthly_totals["count"])
+
+        # Where the columns start in their file and their type, so mapping
+        # them does not parse the header of the file every time
+        with open(self.columns_filename, "rb") as file:
+            if numpy.lib.format.read_magic(file) == (1, 0):
+                _, _, self.columns_dtype = numpy.lib.format.read_array_header_1_0(file)
+            else:
+                _, _, self.columns_dtype = numpy.lib.format.read_array_header_2_0(file)
+            self.columns_offset = file.tell()
+        self.columns = None
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def filenames(cls, ledger_filename, year):
+        """
+        Returns the names of the data, columns and summary files of the
+        partition of year next to ledger_filename.
+        """
+
+        return tuple("{}.{}{}".format(ledger_filename, year, suffix)
+                     for suffix in (cls.data_suffix, cls.columns_suffix, cls.summary_suffix))
+
+    @staticmethod
+    def day_of_year(year, unixtime):
+        """
+        Returns the day of year (starting at 0, in local time) of a unix
+        timestamp, days after the year continue counting.
+        """
+
+        return (datetime.date.fromtimestamp(unixtime) - datetime.date(year, 1, 1)).days
+
+    @staticmethod
+    def combined_codes(cells, keys):
+        """
+        Returns one code per cell (of totals or columns) that combines its
+        codes of keys, the first key varying slowest.
+        """
+
+        combined_codes = numpy.zeros(len(cells[keys[0]]), dtype=numpy.int64)
+        for key in keys:
+            combined_codes = combined_codes * (int(cells[key].max(initial=0)) + 1) + cells[key]
+
+        return combined_codes
+
+    @classmethod
+    def years(cls, ledger_filename):
+        """
+        Returns the sealed years of ledger_filename in order.
+        """
+
+        directory, basename = os.path.split(ledger_filename)
+        pattern = re.compile(re.escape(basename) + r"\.(\d+)" + re.escape(cls.summary_suffix) + "$")
+        matches = [pattern.match(filename) for filename in os.listdir(directory or ".")]
+
+        return sorted(int(match.group(1)) for match in matches if match)
+
+    @classmethod
+    def seal(cls, ledger_filename, year, rows):
+        """
+        Writes the partition of year from its rows (lists in the column order
+        of CSVStorage.column_to_index, ordered by time) and returns it. The
+        summary is written last, without it the partition does not exist.
+        """
+
+        filename, columns_filename, summary_filename = cls.filenames(ledger_filename, year)
+        index = CSVStorage.column_to_index
+        month_starts = numpy.array([month_start(year, month) for month in range(1, 13)], dtype=numpy.int64)
+
+        # Every day is a gzip member of its own, which can be decompressed
+        # without the days before
+        pools = {key: StringPool() for key in cls.encoded_keys}
+        cells = []
+        with open(filename + ".tmp", "wb") as file:
+            for day, day_rows in itertools.groupby(rows, lambda row: cls.day_of_year(year, row[index["time"]])):
+                offset = file.tell()
+                with io.TextIOWrapper(gzip.GzipFile(fileobj=file, mode="wb")) as day_file:
+                    csv_writer = csv.writer(day_file, delimiter=CSVStorage.csv_delimiter,
+                                            quoting=CSVStorage.csv_quoting)
+                    for row in day_rows:
+                        csv_writer.writerow(row)
+                        cells.append((row[index["time"]], row[index["value"]], offset,
+                                       pools["recipient"].encode(row[index["recipient"]]),
+                                       pools["user"].encode(row[index["user"]]),
+                                       pools["category"].encode(row[index["category"]]), 0))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(filename + ".tmp", filename)
+
+        columns = numpy.zeros((), dtype=[(key, dtype, (len(cells),)) for key, dtype in cls.column_types])
+        for key, values in zip(columns.dtype.names, zip(*cells)):
+            columns[key] = values
+        columns["month"] = numpy.searchsorted(month_starts, columns["time"], side="right")
+        with open(columns_filename + ".tmp", "wb") as file:
+            numpy.save(file, columns)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(columns_filename + ".tmp", columns_filename)
+
+        keys = ("month",) + cls.encoded_keys
+        _, first, inverse = numpy.unique(cls.combined_codes(columns, keys), return_index=True, return_inverse=True)
+        values = numpy.bincount(inverse, weights=columns["value"])
+        counts = numpy.bincount(inverse)
+        monthly_totals = [[int(columns[key][row]) for key in keys] + [float(value), int(count)]
+                          for row, value, count in zip(first, values, counts)]
+
+        summary = {key: pools[key].names for key in cls.encoded_keys}
+        summary["size"] = len(cells)
+        summary["monthly_totals"] = monthly_totals
+        with open(summary_filename + ".tmp", "wb") as file:
+            with gzip.GzipFile(fileobj=file, mode="wb") as summary_file:
+                summary_file.write(json.dumps(summary).encode("utf-8"))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(summary_filename + ".tmp", summary_filename)
+
+        return cls(ledger_filename, year)
+
+    def copy(self, ledger_filename):
+        """
+        Copies the partition next to another ledger file (e.g. a backup of
+        the ledger), unless it is there already.
+        """
+
+        filename, columns_filename, summary_filename = self.filenames(ledger_filename, self.year)
+        if os.path.exists(summary_filename):
+            return
+
+        copyfile(self.filename, filename)
+        copyfile(self.columns_filename, columns_filename)
+        copyfile(self.summary_filename, summary_filename + ".tmp")
+        os.replace(summary_filename + ".tmp", summary_filename)
+
+    def __columns(self):
+        """
+        Returns a dict with the columns (see column_types), mapped into
+        memory the first time they are needed.
+        """
+
+        if self.columns is None:
+            record = numpy.memmap(self.columns_filename, dtype=self.columns_dtype, mode="r",
+                                  offset=self.columns_offset, shape=())
+            self.columns = {key: record[key].view(numpy.ndarray) for key in self.columns_dtype.names}
+
+        return self.columns
+
+    def rows(self, from_time=None, to_time=None, recipient=None):
+        """
+        See CSVSnapshot.rows. Rows are read from the compressed file while
+        iterating, starting at the day of from_time.
+        """
+
+        if from_time is not None and from_time >= self.end - 1:
+            return
+        if to_time is not None and to_time <= self.start:
+            return
+
+        offset = 0
+        if from_time is not None and from_time >= self.start:
+            # The day of the first transaction after from_time
+            columns = self.__columns()
+            index = numpy.searchsorted(columns["time"], from_time, side="right")
+            if index == self.size:
+                return
+            offset = int(columns["offset"][index])
+
+        with open(self.filename, "rb") as file:
+            file.seek(offset)
+            # Reads all gzip members from there on
+            reader = csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=file, mode="rb")),
+                                delimiter=CSVStorage.csv_delimiter, quoting=CSVStorage.csv_quoting)
+            for user, value, category, unixtime, row_recipient, comment in reader:
+                unixtime = int(unixtime)
+                if to_time is not None and unixtime >= to_time:
+                    return
+                if (from_time is not None and unixtime <= from_time) or \
+                        (recipient is not None and row_recipient != recipient):
+                    continue
+                yield [user, value, category, unixtime, row_recipient, comment]
+
+    def __group(self, keys, cells, recipient):
+        """
+        Groups cells (monthly or yearly totals, see totals_dtype, or a dict of
+        columns, see column_types) of recipient (or of all recipients if None)
+        by keys, see group_by.
+        """
+
+        if isinstance(cells, numpy.ndarray):
+            cells = {key: cells[key] for key in cells.dtype.names}
+        if recipient is not None:
+            code = self.recipient_codes.get(recipient)
+            if code is None:
+                return dict()
+            indices = numpy.flatnonzero(cells["recipient"] == code)
+            cells = {key: column[indices] for key, column in cells.items()}
+
+        combined_codes = numpy.zeros(len(cells["value"]), dtype=numpy.intp)
+        key_names = []
+        for key in keys:
+            if key == "year":
+                codes, names = 0, [self.year]
+            elif key == "month":
+                codes, names = cells["month"].astype(numpy.intp) - 1, [(self.year, month) for month in range(1, 13)]
+            else:
+                codes, names = cells[key], self.names[key]
+            combined_codes = combined_codes * len(names) + codes
+            key_names.append(names)
+
+        # Columns hold one transaction per cell
+        counts = cells["count"] if "count" in cells else None
+
+        return CSVSnapshot.sum_groups(combined_codes, key_names, cells["value"], counts)
+
+    def group_by(self, keys, from_time, to_time, recipient=None):
+        """
+        Groups the transactions between from_time and to_time (both
+        exclusive) by keys (see Ledger.group_by) and returns a dict mapping
+        tuples with one value per key to the [sum, count] of the transactions
+        in that group.
+        """
+
+        # The first second of the timeframe in this year and the second after
+        first = max(from_time + 1, self.start)
+        end = min(to_time, self.end)
+        if first >= end:
+            return dict()
+
+        if first == self.start and end == self.end and "month" not in keys:
+            return self.__group(keys, self.yearly_totals, recipient)
+
+        # Whole months between first and end are taken from the monthly
+        # totals, only the partial months before and after them from the
+        # columns
+        first_month = month_of(first)
+        first_month_start = month_start(*first_month)
+        if first_month_start < first:
+            first_month_start = month_start(first_month[0], first_month[1] + 1)
+            first_month = month_of(first_month_start)
+        end_month = month_of(end)
+        end_month_start = month_start(*end_month)
+        if first_month_start >= end_month_start:
+            first_month_start = end_month_start = end
+
+        # Months after the year are month 13
+        first_month = first_month[1] if first_month[0] == self.year else 13
+        end_month = end_month[1] if end_month[0] == self.year else 13
+        months = self.monthly_totals["month"]
+        totals = self.__group(keys, self.monthly_totals[(months >= first_month) & (months < end_month)], recipient)
+
+        for partial_first, partial_end in ((first, first_month_start), (end_month_start, end)):
+            if partial_first >= partial_end:
+                continue
+            columns = self.__columns()
+            first_index, end_index = numpy.searchsorted(columns["time"], [partial_first, partial_end], side="left")
+            cells = {key: columns[key][first_index:end_index] for key in ("month", "value") + self.encoded_keys}
+            for group, (value, count) in self.__group(keys, cells, recipient).items():
+                cell = totals.setdefault(group, [.0, 0])
+                cell[0] += value
+                cell[1] += count
+
+        return totals
+class StringPool:
+    """
+    Stores every distinct string once and maps it to an integer code (its
+    index in names). Strings are only ever added, so codes never change.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.codes = dict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def encode(self, name):
+        """
+        Returns the code of name, adding it to the pool if necessary.
+        """
+
+        code = self.codes.get(name)
+        if code is None:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+
+        return code
+
+    def code(self, name):
+        """
+        Returns the code of name or None if it is not in the pool.
+        """
+
+        return self.codes.get(name)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-in for the Telegram Bot API to run the bot without Telegram,
+e.g. for testing or load tests of async_bot.py:
+
+    python fake_telegram.py --port 8081
+
+and set bot_api_url: "http://127.0.0.1:8081" in the configuration. Updates
+for the bot are posted as JSON to /fake/updates (either an update or a list of
+updates, update_id is filled in if missing) and everything the bot sent can
+be fetched from /fake/sent.
+
+Only the methods used by the bot are implemented: getUpdates (with long
+polling), sendMessage, editMessageText, answerCallbackQuery, sendDocument and
+sendMediaGroup. Files are accepted but only their size is kept.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from tornado.escape import json_decode
+from tornado.web import Application, RequestHandler
+
+class FakeTelegram:
+    """
+    State of the fake Bot API: pending updates and everything that was sent.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.sent = []
+        self.new_updates = asyncio.Condition()
+
+    async def push(self, update):
+        async with self.new_updates:
+            if "update_id" not in update:
+                update["update_id"] = self.next_update_id
+            self.next_update_id = max(self.next_update_id, update["update_id"] + 1)
+            self.updates.append(update)
+            self.new_updates.notify_all()
+
+    async def get_updates(self, offset=None, timeout=0, **parameters):
+        async with self.new_updates:
+            if offset is not None:
+                # Confirms all updates before offset
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+            if not self.updates and timeout:
+                try:
+                    await asyncio.wait_for(self.new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+            return list(self.updates)
+
+    def message(self, chat_id, **fields):
+        message = {"message_id": self.next_message_id, "date": int(time.time()), "chat": {"id": int(chat_id)}}
+        message.update(fields)
+        self.next_message_id += 1
+
+        return message
+
+    async def call(self, method, parameters, files):
+        if method == "getUpdates":
+            return await self.get_updates(**parameters)
+
+        self.sent.append({"method": method, "parameters": parameters,
+                          "files": {name: len(data) for name, data in files.items()}})
+        if method == "sendMessage":
+            return self.message(parameters["chat_id"], text=parameters["text"])
+        if method == "editMessageText":
+            return self.message(parameters["chat_id"], text=parameters["text"])
+        if method == "answerCallbackQuery":
+            return True
+        if method == "sendDocument":
+            return self.message(parameters["chat_id"], document={})
+        if method == "sendMediaGroup":
+            return [self.message(parameters["chat_id"]) for _ in parameters["media"]]
+
+        raise KeyError(method)
+
+class BotAPIHandler(RequestHandler):
+    def initialize(self, telegram):
+        self.telegram = telegram
+
+    async def post(self, token, method):
+        files = dict()
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            parameters = json_decode(self.request.body) if self.request.body else dict()
+        else:
+            parameters = dict()
+            for name, values in self.request.body_arguments.items():
+                value = values[0].decode("utf-8")
+                try:
+                    parameters[name] = json.loads(value)
+                except ValueError:
+                    parameters[name] = value
+            files = {name: uploaded[0]["body"] for name, uploaded in self.request.files.items()}
+
+        try:
+            result = await self.telegram.call(method, parameters, files)
+        except KeyError:
+            self.set_status(404)
+            self.write({"ok": False, "error_code": 404, "description": "Not Found: method not found"})
+            return
+        except (TypeError, ValueError) as error:
+            self.set_status(400)
+            self.write({"ok": False, "error_code": 400, "description": "Bad Request: {}".format(error)})
+            return
+
+        self.write(json.dumps({"ok": True, "result": result}))
+        self.set_header("Content-Type", "application/json")
+
+    get = post
+
+class UpdatesHandler(RequestHandler):
+    def initialize(self, telegram):
+        self.telegram = telegram
+
+    async def post(self):
+        updates = json_decode(self.request.body)
+        for update in updates if isinstance(updates, list) else [updates]:
+            await self.telegram.push(update)
+
+class SentHandler(RequestHandler):
+    def initialize(self, telegram):
+        self.telegram = telegram
+
+    def get(self):
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(self.telegram.sent))
+
+def make_application(telegram):
+    arguments = {"telegram": telegram}
+
+    return Application([
+        (r"/bot([^/]*)/(\w+)", BotAPIHandler, arguments),
+        (r"/fake/updates", UpdatesHandler, arguments),
+        (r"/fake/sent", SentHandler, arguments)
+    ])
+
+async def serve(port, address):
+    make_application(FakeTelegram()).listen(port, address)
+    await asyncio.Event().wait()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--address", default="127.0.0.1")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.port, args.address))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
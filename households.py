@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import yaml
+from telegram import InlineKeyboardButton
+
+from balance import BalanceEngine
+from ledger import Ledger, GroupCommitWriter
+from matcher import SynonymMatcher
+
+def set_up_keyboard(categories, prefix):
+    """
+    Given a dict of categories creates a Telegram keyboard (e.g. an input method
+    with a button for each category) and returns it. The callback data of the
+    Telegram keyboard is set as prefix + ":" + the category name.
+
+    Each category should contain a dict that further specifies that category.
+    For the keyboard the "display_name" and "emoji_name" properties are used as
+    the label for the buttons in the keyboard.
+    """
+
+    keyboard = []
+
+    row = []
+    for category, data in categories.items():
+        keyboard_text = "{} {}".format(data.get("display_name", ""), data.get("emoji_name", ""))
+        row.append(InlineKeyboardButton(keyboard_text, callback_data=prefix+":"+category))
+        # Restrict keyboard to two columns so that the labels (ideally) won't be word-wrapped
+        if len(row) == 2:
+            keyboard.append(row)
+            row = []
+
+    if row:
+        keyboard.append(row)
+
+    return keyboard
+
+def telegram_ids(config):
+    return [user_data["telegram_id"] for user_data in config["users"].values() if "telegram_id" in user_data]
+
+class Household:
+    """
+    A household using the bot: its configuration (the configuration of the
+    bot with the users, categories and ledger file of the household) and its
+    open ledger, balances, keyboards and matchers.
+    """
+
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        # The CSV ledger of a new household starts out as an empty file (SQLite
+        # creates the database itself)
+        if not config["ledger_file"].endswith(Ledger.sqlite_extensions):
+            open(config["ledger_file"], "a").close()
+        self.ledger = Ledger(config["ledger_file"], config.get("ledger_compaction_interval", 1000),
+                             config.get("ledger_lazy_loading", False), config.get("ledger_seal_years", True),
+                             config.get("ledger_seal_delay_days", 31))
+        self.ledger_writer = GroupCommitWriter(self.ledger, **config.get("ledger_group_commit", dict()))
+        self.balances = BalanceEngine(self.ledger, config["users"])
+
+        self.recipient_keyboard = set_up_keyboard(config["users"], "recipient")
+        self.user_keyboard = set_up_keyboard(config["users"], "user")
+        self.category_keyboard = set_up_keyboard(config["categories"], "category")
+
+        message_matching = config.get("message_matching", dict())
+        self.user_matcher = SynonymMatcher(config["users"], **message_matching)
+        self.category_matcher = SynonymMatcher(config["categories"], **message_matching)
+
+        # Number of callers using the household right now and when it was
+        # last released (see Households)
+        self.users = 0
+        self.last_used = time.monotonic()
+
+    def close(self):
+        self.ledger_writer.close()
+        self.ledger.close()
+
+class Households:
+    """
+    All households served by the bot. Without a "households" section in the
+    configuration the bot serves a single household, configured by the
+    configuration itself. Otherwise every household has a configuration file
+    of its own in households["directory"] (<name>.yaml), which overrides the
+    configuration of the bot (at least "users" and "categories") and has its
+    own ledger file (<directory>/<name>.csv unless ledger_file is given).
+
+    Only the telegram IDs of all households are kept in memory. Households are
+    opened (their configuration read and their ledger loaded) when they are
+    used and stay open in a least recently used cache of at most
+    households["max_open"] households, which also closes households that
+    were not used for households["max_idle"] seconds (see close_idle). So
+    memory and file handles are bounded by max_open, not by the number of
+    households.
+
+    Households are used by acquiring them, either with use() or with
+    acquire() and release(). Acquired households are never closed, if more
+    are acquired at once than max_open the cache shrinks back once they are
+    released.
+    """
+
+    # Name of the single household without a "households" section
+    default_name = "default"
+
+    def __init__(self, config):
+        self.config = config
+        households_config = config.get("households")
+        self.directory = households_config["directory"] if households_config else None
+        self.max_open = households_config.get("max_open", 16) if households_config else 1
+        self.max_idle = households_config.get("max_idle", 3600) if households_config else None
+
+        self.names = self.household_names()
+        # Telegram ID of every user to the name of their household
+        self.household_of_user = dict()
+        for name in self.names:
+            for telegram_id in telegram_ids(self.household_config(name)):
+                if self.household_of_user.get(telegram_id, name) != name:
+                    raise ValueError("Telegram ID {} belongs to the households {} and {}".format(
+                        telegram_id, self.household_of_user[telegram_id], name))
+                self.household_of_user[telegram_id] = name
+
+        self.open_households = OrderedDict()
+        self.lock = threading.Lock()
+        # Held while a household is opened or closed, so its ledger is never
+        # open twice
+        self.household_locks = {name: threading.Lock() for name in self.names}
+
+    def household_names(self):
+        if self.directory is None:
+            return [self.default_name]
+
+        return sorted(filename[:-len(".yaml")] for filename in os.listdir(self.directory)
+                      if filename.endswith(".yaml"))
+
+    def household_config(self, name):
+        if self.directory is None:
+            return self.config
+
+        config = {key: value for key, value in self.config.items() if key != "households"}
+        config["ledger_file"] = os.path.join(self.directory, name + ".csv")
+        with open(os.path.join(self.directory, name + ".yaml")) as file:
+            config.update(yaml.safe_load(file))
+
+        return config
+
+    def find(self, telegram_id):
+        """
+        Returns the name of the household of the user with telegram_id or None
+        if they are not allowed to use the bot.
+        """
+
+        return self.household_of_user.get(telegram_id)
+
+    def acquire(self, name):
+        """
+        Returns the household name, opening it if necessary. It stays open
+        until it is released again.
+        """
+
+        while True:
+            with self.lock:
+                household = self.open_households.get(name)
+                if household is not None:
+                    household.users += 1
+                    self.open_households.move_to_end(name)
+                    return household
+
+            with self.household_locks[name]:
+                with self.lock:
+                    if name in self.open_households:
+                        # Opened by someone else in the meantime
+                        continue
+                # Loading the ledger does not keep other households waiting
+                household = Household(name, self.household_config(name))
+                with self.lock:
+                    household.users = 1
+                    self.open_households[name] = household
+                break
+
+        self.__close(self.__evict(lambda household: len(self.open_households) > self.max_open))
+        return household
+
+    def release(self, household):
+        with self.lock:
+            household.users -= 1
+            household.last_used = time.monotonic()
+
+        self.__close(self.__evict(lambda household: len(self.open_households) > self.max_open))
+
+    @contextmanager
+    def use(self, name):
+        """
+        Context manager acquiring the household name and releasing it again.
+        """
+
+        household = self.acquire(name)
+        try:
+            yield household
+        finally:
+            self.release(household)
+
+    def __evict(self, condition):
+        """
+        Removes the households that are not acquired and for which
+        condition(household) holds (least recently used first) and returns
+        them with their lock held, to be closed by __close.
+        """
+
+        evicted = []
+        with self.lock:
+            for household in list(self.open_households.values()):
+                if household.users > 0 or not condition(household):
+                    continue
+                # Only held by whoever opens or closes the household, so this
+                # does not fail for an open household in practice
+                if not self.household_locks[household.name].acquire(blocking=False):
+                    continue
+                del self.open_households[household.name]
+                evicted.append(household)
+
+        return evicted
+
+    def __close(self, households):
+        for household in households:
+            try:
+                household.close()
+            finally:
+                self.household_locks[household.name].release()
+
+    def backup(self, name, suffix):
+        """
+        Backs up the ledger of the household name to its ledger file with
+        suffix appended. An open household backs up its ledger (see
+        Ledger.backup), otherwise the files of the ledger are copied without
+        opening the household (see Ledger.backup_files), which can't be opened
+        in the meantime. So backups neither load ledgers nor close households
+        that are in use.
+        """
+
+        with self.household_locks[name]:
+            with self.lock:
+                household = self.open_households.get(name)
+                if household is not None:
+                    # Not closed until it is backed up
+                    household.users += 1
+            if household is None:
+                ledger_file = self.household_config(name)["ledger_file"]
+                Ledger.backup_files(ledger_file, ledger_file + suffix)
+                return
+
+        try:
+            household.ledger.backup(household.config["ledger_file"] + suffix)
+        finally:
+            with self.lock:
+                household.users -= 1
+
+    def close_idle(self):
+        """
+        Closes all households that were not used for max_idle seconds.
+        """
+
+        if self.max_idle is None:
+            return
+
+        deadline = time.monotonic() - self.max_idle
+        self.__close(self.__evict(lambda household: household.last_used < deadline))
+
+    def open_count(self):
+        with self.lock:
+            return len(self.open_households)
+
+    def transactions(self):
+        """
+        Returns the number of transactions in the ledgers of all open
+        households.
+        """
+
+        with self.lock:
+            households = list(self.open_households.values())
+
+        return sum(len(household.ledger) for household in households)
+
+    def close(self):
+        self.__close(self.__evict(lambda household: True))
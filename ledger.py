@@ -2,42 +2,107 @@
 # -*- coding: utf-8 -*-
 
 import csv
-import io
+import os
+import threading
 import time
 
+from csv_storage import CSVStorage
+from metrics import metrics
+from sqlite_storage import SQLiteStorage
+
 class Ledger:
     """
     The ledger contains all financial expenses in one large table with 6
     columns: user (who payed?), value, category, time (as unix timestamp),
     recipient (who was the purchase for?) and an optional comment.
-    
+
     New purchases can be entered into the ledger and expenses per category or
     per user for specific timeframes and specific recipients can be calculated.
 
-    Ledger data is persisted in a CSV file.
+    Ledger data is persisted by a storage backend that is chosen by the file
+    extension of the ledger file: SQLite databases (.sqlite, .sqlite3 or .db)
+    are stored by SQLiteStorage, everything else is treated as a CSV file and
+    stored by CSVStorage (which seals closed years into compressed files
+    unless seal_years is False, see CSVStorage).
+
+    The ledger can be used from many threads at once. Entries are written by
+    one thread at a time, while queries read from snapshots of the ledger and
+    neither wait for writers nor see half-written entries. Several queries
+    that have to agree with each other (e.g. everything shown in one report)
+    can share one snapshot.
     """
 
-    column_to_index = {
-        "user": 0,
-        "value": 1,
-        "category": 2,
-        "time": 3,
-        "recipient": 4,
-        "comment": 5
-    }
+    sqlite_extensions = (".sqlite", ".sqlite3", ".db")
 
-    csv_delimiter = " "
-    csv_quoting = csv.QUOTE_NONNUMERIC
+    # Columns of exported CSV files
+    export_header = ["user", "value", "category", "time", "recipient", "comment"]
+    export_time_format = "%Y-%m-%d %H:%M:%S"
 
-    def __init__(self, filename):
-        self.ledger = []
+    def __init__(self, filename, compaction_interval=1000, lazy_loading=False, seal_years=True, seal_delay_days=31):
         self.filename = filename
 
-        with open(filename) as file:
-            for row in csv.reader(file, delimiter=self.csv_delimiter, quoting=self.csv_quoting):
-                self.ledger.append(row)
+        if os.path.splitext(filename)[1] in self.sqlite_extensions:
+            self.storage = SQLiteStorage(filename)
+        else:
+            self.storage = CSVStorage(filename, compaction_interval, lazy_loading, seal_years, seal_delay_days)
+        self.listeners = []
 
-    def enter(self, user, value, category="", unixtime=None, recipient="", comment=""):
+    def __len__(self):
+        return len(self.storage)
+
+    @property
+    def generation(self):
+        """
+        Number that changes whenever a transaction is entered into the ledger
+        (also across restarts), e.g. to know if cached reports are outdated.
+        """
+
+        return self.storage.generation
+
+    def snapshot(self):
+        """
+        Returns a consistent, read-only view of the ledger as it is now, which
+        offers rows, group_by and generation (and len) like the ledger itself
+        but is not affected by entries made afterwards. Use it in a with
+        statement:
+
+            with ledger.snapshot() as snapshot:
+                snapshot.group_by(...)
+        """
+
+        return self.storage.snapshot()
+
+    def rows(self, from_time=None, to_time=None, recipient=None):
+        """
+        Iterates over all transactions (ordered by time) as lists in the column
+        order of CSVStorage.column_to_index, optionally only those between
+        from_time and to_time (both exclusive) and those made for recipient.
+        """
+
+        return self.storage.rows(from_time, to_time, recipient)
+
+    def export(self, file, from_time=None, to_time=None, recipient=None):
+        """
+        Writes the transactions between from_time and to_time (both exclusive),
+        optionally only those made for recipient, to file (opened in text mode
+        with newline="") as a comma separated CSV file with a header and
+        readable local times, e.g. for an accountant. Rows are written one by
+        one while reading them from a snapshot of the ledger. Returns the
+        number of exported transactions.
+        """
+
+        csv_writer = csv.writer(file)
+        csv_writer.writerow(self.export_header)
+        count = 0
+        with self.snapshot() as snapshot:
+            for row in snapshot.rows(from_time, to_time, recipient):
+                row[3] = time.strftime(self.export_time_format, time.localtime(row[3]))
+                csv_writer.writerow(row)
+                count += 1
+
+        return count
+
+    def __row(self, user, value, category="", unixtime=None, recipient="", comment=""):
         if not unixtime:
             unixtime = int(time.time())
 
@@ -46,41 +111,96 @@ class Ledger:
         if recipient == "":
             recipient = user
 
-        self.ledger.append([user, value, category, unixtime, recipient, comment])
-        with open(self.filename, "w") as file:
-            csv_writer = csv.writer(file, delimiter=self.csv_delimiter, quoting=self.csv_quoting)
-            csv_writer.writerows(self.ledger)
+        return [user, value, category, unixtime, recipient, comment]
+
+    def check_entry(self, user, value, category="", unixtime=None, recipient="", comment=""):
+        """
+        Raises a ValueError if the purchase (see enter) can't be entered, e.g.
+        because its year is sealed (see CSVStorage). Lets writers that enter
+        purchases of many callers at once reject a single purchase before it
+        fails the whole batch.
+        """
+
+        self.storage.check([self.__row(user, value, category, unixtime, recipient, comment)])
+
+    def listen(self, listener):
+        """
+        Calls listener(rows, generation) whenever transactions are entered from
+        now on, with the entered rows (in the column order of
+        CSVStorage.column_to_index) and the generation of the ledger once they
+        were entered. A snapshot contains the rows if its generation is at
+        least as high.
+        """
+
+        self.listeners.append(listener)
+
+    def __append(self, rows):
+        generation = self.storage.append(rows)
+        for listener in self.listeners:
+            listener(rows, generation)
+
+    @metrics.timed("ledger_enter_seconds", "Time to enter purchases into the ledger (one or many at once)")
+    def enter(self, user, value, category="", unixtime=None, recipient="", comment=""):
+        self.__append([self.__row(user, value, category, unixtime, recipient, comment)])
+
+    @metrics.timed("ledger_enter_seconds")
+    def enter_many(self, entries):
+        """
+        Enters many purchases at once (e.g. when importing a bank statement),
+        which are written to disk together instead of one by one. Every entry
+        is a dict with the keyword arguments of enter.
+        """
+
+        self.__append([self.__row(**entry) for entry in entries])
+
+    def backup(self, filename):
+        """
+        Writes a consistent copy of the complete ledger to filename (in the
+        format of the storage backend).
+        """
 
-    def __filter_time_and_recipient(self, from_time, to_time, recipient):
-        filtered_ledger = []
-        time_index = self.column_to_index["time"]
-        recipient_index = self.column_to_index["recipient"]
+        self.storage.backup(filename)
 
-        for transaction in self.ledger:
-            pass_time_filter = transaction[time_index] < to_time and transaction[time_index] > from_time
-            pass_recipient_filter = transaction[recipient_index] == recipient
-            if pass_time_filter and pass_recipient_filter:
-                filtered_ledger.append(transaction)
+    @classmethod
+    def backup_files(cls, filename, backup_filename):
+        """
+        Like backup, but for a ledger that is not open: the files of the ledger
+        filename are copied to backup_filename without loading the ledger.
+        """
 
-        return filtered_ledger
+        # Households that were never used have no ledger yet
+        if not os.path.exists(filename):
+            return
+
+        if os.path.splitext(filename)[1] in cls.sqlite_extensions:
+            SQLiteStorage.backup_files(filename, backup_filename)
+        else:
+            CSVStorage.backup_files(filename, backup_filename)
+
+    def close(self):
+        self.storage.close()
+
+    def group_by(self, keys, from_time, to_time, recipient=None):
+        """
+        Sums up the values of all transactions between from_time and to_time
+        (both exclusive), optionally only those made for recipient, grouped by
+        every combination of keys. Keys can be any of "user", "category",
+        "recipient", "month" or "year" (in local time).
+
+        Returns a dict mapping tuples with one value per key (months are
+        (year, month) tuples) to the summarized expenses. Only combinations
+        that occur in the ledger are contained.
+        """
+
+        return self.storage.group_by(keys, from_time, to_time, recipient)
 
     def __calculate_expenses_per_x(self, from_time, to_time, recipient, x, sort):
-        filtered_ledger = self.__filter_time_and_recipient(from_time, to_time, recipient)
-        x_index = self.column_to_index[x]
-        value_index = self.column_to_index["value"]
-        
-        # Dictionary containing summarized expenses for every distinct value in
-        # column x (e.g. if x is the user column this is a dict mapping each
-        # user to a value of all the money spent on purchases for the specified
-        # recipient)
-        sums = dict()
-        for transaction in filtered_ledger:
-            x_value = transaction[x_index]
-            if not (x_value in sums):
-                sums[x_value] = .0
-            sums[x_value] += transaction[value_index]
-
-        result = sums.items()
+        # Summarized expenses for every distinct value in column x (e.g. if x is
+        # the user column this holds all the money spent on purchases for the
+        # specified recipient by each user)
+        sums = self.group_by((x,), from_time, to_time, recipient)
+        result = [(group[0], value) for group, value in sums.items()]
+
         if sort:
             result = sorted(result, key=lambda x: x[1], reverse=True)
 
@@ -90,4 +210,90 @@ class Ledger:
         return self.__calculate_expenses_per_x(from_time, to_time, recipient, "category", sort)
 
     def calculate_expenses_per_user(self, from_time, to_time, recipient, sort=False):
-        return self.__calculate_expenses_per_x(from_time, to_time, recipient, "user", sort)
\ No newline at end of file
+        return self.__calculate_expenses_per_x(from_time, to_time, recipient, "user", sort)
+
+class GroupCommitWriter:
+    """
+    Enters purchases from many threads into a ledger in batches.
+
+    Entries are queued and a single writer thread enters everything that
+    arrived within max_delay seconds (or up to max_batch entries) at once with
+    Ledger.enter_many, so a burst of purchases costs one write (and sync) to
+    disk instead of one per purchase. enter only returns once the entry was
+    written, so callers can rely on it being stored durably.
+    """
+
+    def __init__(self, ledger, max_batch=64, max_delay=0.005):
+        self.ledger = ledger
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = []
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.__run, name="GroupCommitWriter", daemon=True)
+        self.thread.start()
+
+    def enter(self, user, value, category="", unixtime=None, recipient="", comment=""):
+        """
+        Enters a purchase (see Ledger.enter) and waits until it is written.
+        """
+
+        request = {
+            "entry": {"user": user, "value": value, "category": category, "unixtime": unixtime,
+                      "recipient": recipient, "comment": comment},
+            "written": threading.Event(),
+            "error": None
+        }
+        self.ledger.check_entry(**request["entry"])
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("GroupCommitWriter is closed")
+            self.queue.append(request)
+            self.condition.notify()
+
+        request["written"].wait()
+        if request["error"] is not None:
+            raise request["error"]
+
+    def __next_batch(self):
+        with self.condition:
+            while not self.queue and not self.closed:
+                self.condition.wait()
+
+            # Give other threads a moment to add their entries to the batch
+            deadline = time.monotonic() + self.max_delay
+            while len(self.queue) < self.max_batch and not self.closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            batch = self.queue[:self.max_batch]
+            del self.queue[:self.max_batch]
+
+        return batch
+
+    def __run(self):
+        while True:
+            batch = self.__next_batch()
+            if not batch:
+                return
+
+            try:
+                self.ledger.enter_many([request["entry"] for request in batch])
+            except Exception as error:
+                for request in batch:
+                    request["error"] = error
+
+            for request in batch:
+                request["written"].set()
+
+    def close(self):
+        """
+        Writes all queued entries and stops the writer thread.
+        """
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+
+def trie_pattern(trie):
+    """
+    Turns a trie (nested dicts mapping characters to subtries, where the key ""
+    marks the end of a term) into a regular expression matching all of its
+    terms. Terms with a common prefix share one branch of the expression, so
+    the regex engine never compares the same prefix twice, and longer terms are
+    preferred over their prefixes.
+    """
+
+    alternatives = [re.escape(character) + trie_pattern(subtrie)
+                    for character, subtrie in sorted(trie.items()) if character != ""]
+    if not alternatives:
+        return ""
+
+    pattern = alternatives[0] if len(alternatives) == 1 else "(?:" + "|".join(alternatives) + ")"
+    if "" in trie:
+        pattern = "(?:" + pattern + ")?"
+
+    return pattern
+
+class SynonymMatcher:
+    """
+    Recognizes names (e.g. users or categories) in messages by the name itself
+    or one of its synonyms.
+
+    The names are given as a dict mapping each name to a dict with an optional
+    list of "synonyms" (like the users and categories in the configuration).
+    All names and synonyms are compiled into one regular expression once, so a
+    message is searched in a single pass no matter how many synonyms there
+    are. Matching can ignore case and can be restricted to whole words.
+    """
+
+    def __init__(self, names, ignore_case=False, word_boundaries=False):
+        self.ignore_case = ignore_case
+
+        # Maps every term (a name or synonym) to its name, names take
+        # precedence over synonyms of other names
+        self.terms = dict()
+        for name, data in names.items():
+            for synonym in data.get("synonyms") or []:
+                self.terms.setdefault(self.__normalize(synonym), name)
+        for name in names:
+            self.terms[self.__normalize(name)] = name
+
+        trie = dict()
+        for term in self.terms:
+            if not term:
+                continue
+            node = trie
+            for character in term:
+                node = node.setdefault(character, dict())
+            node[""] = True
+
+        pattern = trie_pattern(trie)
+        if not pattern:
+            # Never matches anything
+            pattern = "(?!)"
+        elif word_boundaries:
+            pattern = r"(?<!\w)" + pattern + r"(?!\w)"
+
+        self.regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        # Matches the longest term starting at every position of a message,
+        # also terms overlapping each other
+        self.overlapping_regex = re.compile("(?=(" + pattern + "))", re.IGNORECASE if ignore_case else 0)
+
+    def __normalize(self, term):
+        return term.lower() if self.ignore_case else term
+
+    def __name_of(self, text):
+        """
+        Returns the name of the term that matched text. The regular expression
+        ignores case character by character, which does not always agree with
+        str.lower (e.g. "ſ" matches "s"), so text that is not a normalized term
+        is compared with every term the way the regular expression does.
+        """
+
+        name = self.terms.get(self.__normalize(text))
+        if name is not None:
+            return name
+
+        for term, name in self.terms.items():
+            if re.fullmatch(re.escape(term), text, re.IGNORECASE):
+                return name
+
+    def find_all(self, message):
+        """
+        Returns a list of (name, start, end) tuples for every name or synonym
+        found in message, in the order in which they occur. Terms are found
+        from left to right and do not overlap, so a term overlapping one found
+        before is left out.
+        """
+
+        return [(self.__name_of(match.group()), match.start(), match.end())
+                for match in self.regex.finditer(message)]
+
+    def find(self, message):
+        """
+        Returns the name whose name or synonym matches the longest part of
+        message (the first one if several match equally long parts) or an
+        empty string if none is found.
+        """
+
+        best_term = ""
+        for match in self.overlapping_regex.finditer(message):
+            if len(match.group(1)) > len(best_term):
+                best_term = match.group(1)
+
+        return self.__name_of(best_term) if best_term else ""
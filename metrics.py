@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds (in seconds) of the buckets of latency histograms
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, "", self.value)]
+
+class Gauge:
+    """
+    Value that can go up and down. If a function is given, it is called to
+    get the value whenever the gauge is read.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function else self.value
+
+    def samples(self):
+        return [(self.name, "", self.get())]
+
+class Histogram:
+    """
+    Counts observed values (e.g. latencies in seconds) in buckets with fixed
+    upper bounds, like a Prometheus histogram. Quantiles are estimated from
+    the buckets, so observing a value costs the same no matter how many values
+    were observed before.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = .0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.count += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        """
+        Context manager observing the time (in seconds) spent inside of it.
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def quantile(self, q):
+        """
+        Estimates the q-quantile by interpolating linearly inside the bucket
+        containing it (None if nothing was observed).
+        """
+
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+        if count == 0:
+            return None
+
+        rank = q * count
+        cumulative = 0
+        lower_bound = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            if bucket_count and cumulative + bucket_count >= rank:
+                if bound == float("inf"):
+                    return lower_bound
+                return lower_bound + (bound - lower_bound) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+            lower_bound = bound
+
+        return lower_bound
+
+    def samples(self):
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            sum = self.sum
+
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append((self.name + "_bucket", '{{le="{}"}}'.format(format_value(bound)), cumulative))
+        samples.append((self.name + "_count", "", count))
+        samples.append((self.name + "_sum", "", sum))
+
+        return samples
+
+class Metrics:
+    """
+    Registry of all counters, gauges and histograms of the bot, which can be
+    rendered in the Prometheus text format or as a short summary for humans.
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+
+    def __get(self, cls, name, *args):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args)
+                self.metrics[name] = metric
+
+        return metric
+
+    def counter(self, name, help=""):
+        return self.__get(Counter, name, help)
+
+    def gauge(self, name, help="", function=None):
+        gauge = self.__get(Gauge, name, help)
+        if function is not None:
+            gauge.function = function
+
+        return gauge
+
+    def histogram(self, name, help="", buckets=default_buckets):
+        return self.__get(Histogram, name, help, buckets)
+
+    def timed(self, name, help=""):
+        """
+        Decorator observing the time every call of the decorated function
+        takes (in seconds) in the histogram name.
+        """
+
+        histogram = self.histogram(name, help)
+
+        def decorator(function):
+            @wraps(function)
+            def wrapped(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start)
+            return wrapped
+
+        return decorator
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            if metric.help:
+                lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, labels, format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns one line per metric: the value of counters and gauges and the
+        number of calls, p50 and p99 of histograms.
+        """
+
+        lines = ["uptime: {:.0f} s".format(time.time() - self.start_time)]
+        with self.lock:
+            metrics = list(self.metrics.values())
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                if metric.count == 0:
+                    lines.append("{}: -".format(metric.name))
+                    continue
+                lines.append("{}: {} × p50 {:.1f} ms p99 {:.1f} ms".format(
+                    metric.name, metric.count, metric.quantile(.5) * 1000, metric.quantile(.99) * 1000))
+            elif isinstance(metric, Gauge):
+                lines.append("{}: {}".format(metric.name, metric.get()))
+            else:
+                lines.append("{}: {}".format(metric.name, metric.value))
+
+        return "\n".join(lines)
+
+    def write(self, filename):
+        """
+        Atomically writes the metrics in the Prometheus text format to filename
+        (e.g. for the textfile collector of the node exporter).
+        """
+
+        temporary_filename = filename + ".tmp"
+        with open(temporary_filename, "w") as file:
+            file.write(self.prometheus_text())
+        os.replace(temporary_filename, filename)
+
+    def serve(self, port, address=""):
+        """
+        Serves the metrics in the Prometheus text format on /metrics from a
+        background thread and returns the server.
+        """
+
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((address, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="Metrics", daemon=True)
+        thread.start()
+
+        return server
+
+# Metrics of the whole bot
+metrics = Metrics()
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+def month_start(year, month):
+    """
+    Returns the unix timestamp of the first second of a month in local time.
+    Months after December continue in the following year(s).
+    """
+
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+
+    return int(time.mktime((year, month, 1, 0, 0, 0, 0, 0, -1)))
+
+def month_of(unixtime):
+    """
+    Returns the month (as a (year, month) tuple) a unix timestamp falls in,
+    in local time.
+    """
+
+    local_time = time.localtime(unixtime)
+
+    return (local_time.tm_year, local_time.tm_mon)
+
+def day_start(date):
+    """
+    Returns the unix timestamp of the first second of a date (or of the day
+    of a datetime) in local time.
+    """
+
+    return int(time.mktime((date.year, date.month, date.day, 0, 0, 0, 0, 0, -1)))
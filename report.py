@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import time
-import datetime
-import calendar
-from matplotlib import pyplot
+import matplotlib
+from matplotlib.artist import setp
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties, findfont
 import squarify
 import io
 
 from ledger import Ledger
+from metrics import metrics
+from report_data import collect_report_data, pivot_keys
 
 plural = {
     "user": "users",
@@ -28,7 +30,7 @@ def plot_hbars(ax, categories, values, colors=None, title=None):
     ax.grid(visible=True, which="major", axis="x")
 
     labels = ax.get_xticklabels()
-    pyplot.setp(labels, rotation=45, horizontalalignment="right")
+    setp(labels, rotation=45, horizontalalignment="right")
     ax.xaxis.set_major_formatter(currency)
 
     container = ax.barh(list(reversed(categories)), list(reversed(values)), height=.8, color=list(reversed(colors)))
@@ -84,7 +86,7 @@ def plot_stacked_bar(ax, categories, values, colors=None, title=""):
     ax.grid(visible=False, axis="x")
 
     xticklabels = ax.get_xticklabels()
-    pyplot.setp(xticklabels, rotation=45, horizontalalignment="right")
+    setp(xticklabels, rotation=45, horizontalalignment="right")
     ax.yaxis.set_major_formatter(currency)
 
     plot_stacked(ax, categories, values, colors, title)
@@ -96,27 +98,47 @@ def plot_stacked_hbar(ax, categories, values, colors=None, title=""):
     ax.grid(visible=True, which="major", axis="x")
 
     xticklabels = ax.get_xticklabels()
-    pyplot.setp(xticklabels, rotation=45, horizontalalignment="right")
+    setp(xticklabels, rotation=45, horizontalalignment="right")
     ax.xaxis.set_major_formatter(currency)
 
     plot_stacked(ax, categories, values, colors, title, horizontal=True)
 
     return 1
 
-def save_to_buffer(fig):
+def save_to_buffer(fig, format="pdf", dpi=300):
     buffer = io.BytesIO()
-    fig.savefig(buffer, format="pdf")
+    fig.savefig(buffer, format=format, dpi=dpi)
     buffer.seek(0)
 
     return buffer
 
-def calculate_data_and_plot(ax, plot, ledger, from_time, to_time, recipient, config, automatic_title):
+def summarize(pivot, per, sort):
+    """
+    Sums up a pivot as returned by Ledger.group_by for pivot_keys per user or
+    per category. Returns a list of (name, value) tuples just like the
+    calculate_expenses_per_* methods of the ledger.
+    """
+
+    index = pivot_keys.index(per)
+    sums = dict()
+    for group, value in pivot.items():
+        sums[group[index]] = sums.get(group[index], .0) + value
+
+    result = list(sums.items())
+    if sort:
+        result = sorted(result, key=lambda x: x[1], reverse=True)
+
+    return result
+
+def calculate_data_and_plot(ax, plot, pivot, config, automatic_title):
     hbars = 0
     for data in reversed(plot):
         sort = False
         if "sort" in data:
             sort = data["sort"]
-        result = getattr(ledger, "calculate_" + data["what"] + "_per_" + data["per"])(from_time, to_time, recipient, sort)
+        # The pivot contains the summarized expenses, which is the only thing
+        # that can be plotted (data["what"]) at the moment
+        result = summarize(pivot, data["per"], sort)
         categories = list(map(lambda x: config[plural[data["per"]]][x[0]]["display_name"], result))
         values = list(map(lambda x: x[1], result))
         colors = list(map(lambda x: config[plural[data["per"]]][x[0]]["color"], result))
@@ -129,70 +151,119 @@ def calculate_data_and_plot(ax, plot, ledger, from_time, to_time, recipient, con
 
     return hbars
 
-def generate_report(type, user, ledger, config):
+class ReportRenderer:
     """
-    Generates a report (a plot using Matplotlib) for the specified user from the
-    given ledger. Returns a buffer containing the image.
+    Renders reports (plots using Matplotlib) from the data collected by
+    report_data.collect_report_data.
+
+    The style and fonts are loaded once when the renderer is created and only
+    applied while a report is rendered, nothing is changed in Matplotlib's
+    global state. Figures are created with the object-oriented Figure API, so
+    they are never registered with pyplot, and are released after they were
+    saved, so rendering many reports does not accumulate memory.
+
+    The output format (anything Matplotlib can save, e.g. "pdf" or "png") and
+    the resolution are configurable, a PNG with a lower resolution is much
+    lighter for previews in Telegram than a 300 dpi PDF.
     """
 
-    pyplot.style.use('style.mplstyle')
-    pyplot.rcParams.update({'figure.autolayout': True,
-                            'font.family': 'sans-serif',
-                            'font.sans-serif': 'Noto Emoji',
-                            'font.size': '15'})
-    pyplot.rcParams['font.family'] = ['Roboto Condensed', 'sans-serif']
-
-    report_axes = config[type + "_report"]["figures"]
-    fig, axs = pyplot.subplots(len(report_axes), 1)
-    today = datetime.date.today()
-    fig.suptitle(
-        config[type + "_report"]["title"] + " {} (bis {})".format(today.strftime("%Y"), today.strftime("%d.%m.")),
-        fontsize=25,
-        fontweight="bold")
-    fig.set_size_inches(11.69, 16.54, forward=True)
-    fig.set_dpi(300)
-    hsizes = []
+    size_in_inches = (11.69, 16.54)
+
+    def __init__(self, config, style="style.mplstyle", format="pdf", dpi=300):
+        self.config = config
+        self.format = format
+        self.dpi = dpi
+
+        self.style = matplotlib.rc_params_from_file(style, use_default_template=True)
+        self.style.update({'figure.autolayout': True,
+                           'font.family': ['Roboto Condensed', 'sans-serif'],
+                           'font.sans-serif': 'Noto Emoji',
+                           'font.size': 15})
+
+        # Look up the fonts now, Matplotlib caches them for all reports
+        with matplotlib.rc_context(self.style):
+            findfont(FontProperties(family=self.style["font.family"]))
+
+    def render(self, snapshot):
+        """
+        Renders a report from the data collected by collect_report_data and
+        returns the image as bytes.
+        """
+
+        with matplotlib.rc_context(self.style):
+            fig = Figure(figsize=self.size_in_inches, dpi=self.dpi)
+            try:
+                self.__draw(fig, snapshot)
+                buffer = save_to_buffer(fig, self.format, self.dpi)
+            finally:
+                fig.clear()
+
+        data = buffer.getvalue()
+        buffer.close()
+
+        return data
+
+    def warm_up(self):
+        """
+        Draws and saves a tiny figure, so that the backend and fonts are loaded
+        before the first report is rendered.
+        """
+
+        with matplotlib.rc_context(self.style):
+            fig = Figure(figsize=(1, 1), dpi=10)
+            fig.text(.5, .5, "0 €")
+            save_to_buffer(fig, self.format, 10).close()
+            fig.clear()
+
+    def __draw(self, fig, snapshot):
+        config = self.config
+        type = snapshot["type"]
+        report_axes = config[type + "_report"]["figures"]
+        axs = fig.subplots(len(report_axes), 1, squeeze=False)[:, 0]
+        today = snapshot["today"]
+        fig.suptitle(
+            config[type + "_report"]["title"] + " {} (bis {})".format(today.strftime("%Y"), today.strftime("%d.%m.")),
+            fontsize=25,
+            fontweight="bold")
+        hsizes = []
+
+        i = 0
+        for report_axe, panels in zip(report_axes, snapshot["figures"]):
+            ax = axs[i]
+
+            ax.spines["top"].set_visible(False)
+            ax.spines["right"].set_visible(False)
+            ax.spines["bottom"].set_visible(True)
+            ax.spines["left"].set_visible(True)
+
+            if "title" in report_axe:
+                ax.set_title(report_axe["title"], loc="center")
+
+            hbars = 0
+            for title, pivot in panels:
+                # Panels of one figure are drawn on top of each other, so only
+                # the last one determines the number of bars
+                hbars = calculate_data_and_plot(ax, report_axe["plot"], pivot, config, title)
+
+            hsizes.append(hbars)
+
+            #axs[i].set_box_aspect(hbars/4)
+
+            i += 1
+
+def renderer_from_config(config):
+    """
+    Creates a ReportRenderer with the output format and resolution set in the
+    configuration.
+    """
 
-    i = 0
-    for report_axe in report_axes:
-        ax = axs[i]
-
-        ax.spines["top"].set_visible(False)
-        ax.spines["right"].set_visible(False)
-        ax.spines["bottom"].set_visible(True)
-        ax.spines["left"].set_visible(True)
-
-        if "title" in report_axe:
-            ax.set_title(report_axe["title"], loc="center")
-
-        recipient = report_axe["recipient"]
-        if recipient == "user":
-            recipient = user
-
-        hbars = 0
-        if report_axe["period"] == "year" or report_axe["period"] == "month":
-            from_time = 0
-            to_time = 9999999999
-            if report_axe["period"] == "month":
-                from_time = time.mktime(datetime.date(today.year, today.month, 1).timetuple())
-                to_time = time.mktime(today.timetuple())
-            
-            hbars += calculate_data_and_plot(ax, report_axe["plot"], ledger, from_time, to_time, recipient, config, "default")
-        elif report_axe["period"] == "per_month_of_year":
-            local_hbars = 0
-            for month in range(1, 13):
-                from_time_date = datetime.date(today.year, month, 1)
-                from_time = time.mktime(from_time_date.timetuple())
-                (_, last_day) = calendar.monthrange(today.year, month)
-                to_time = time.mktime(datetime.date(today.year, month, last_day).timetuple())
-
-                local_hbars = calculate_data_and_plot(ax, report_axe["plot"], ledger, from_time, to_time, recipient, config, "{}".format(from_time_date.strftime("%b")))
-            hbars += local_hbars
-
-        hsizes.append(hbars)
-
-        #axs[i].set_box_aspect(hbars/4)
+    return ReportRenderer(config, format=config.get("report_format", "pdf"), dpi=config.get("report_dpi", 300))
 
-        i += 1
+@metrics.timed("report_generate_seconds", "Time to generate a report in the calling process")
+def generate_report(type, user, ledger, config):
+    """
+    Generates a report (a plot using Matplotlib) for the specified user from the
+    given ledger. Returns a buffer containing the image.
+    """
 
-    return save_to_buffer(fig)
\ No newline at end of file
+    return io.BytesIO(renderer_from_config(config).render(collect_report_data(type, user, ledger, config)))
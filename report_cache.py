@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+def report_cache_key(household, type, user, generation, config, date):
+    """
+    Returns the key under which a rendered report of the household is cached.
+    A report only changes if the ledger of the household changed (its
+    generation), the parts of the configuration used for reports changed or
+    on another day (the title shows the date and the current month depends on
+    it).
+    """
+
+    report_config = {
+        "users": config["users"],
+        "categories": config["categories"],
+        "report": config[type + "_report"],
+        "format": config.get("report_format", "pdf"),
+        "dpi": config.get("report_dpi", 300)
+    }
+    config_hash = hashlib.sha1(json.dumps(report_config, sort_keys=True).encode("utf-8")).hexdigest()
+    key = json.dumps([household, type, user, generation, config_hash, date.isoformat()])
+
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+class ReportCache:
+    """
+    Least recently used cache of rendered reports (as bytes) bounded by the
+    total size of the reports it holds in memory.
+
+    If a directory is given, reports evicted from memory are spilled to files in
+    that directory (bounded by max_disk_bytes, removing the oldest files first)
+    and moved back into memory when they are requested again.
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, directory=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def __spill_filename(self, key):
+        return os.path.join(self.directory, key + ".report")
+
+    def get(self, key):
+        """
+        Returns the cached report for key or None.
+        """
+
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                return data
+
+        if not self.directory:
+            return None
+
+        try:
+            with open(self.__spill_filename(key), "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+
+        self.put(key, data)
+        return data
+
+    def put(self, key, data):
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            self.entries[key] = data
+            self.size += len(data)
+
+            while self.size > self.max_bytes and len(self.entries) > 1:
+                evicted_key, evicted_data = self.entries.popitem(last=False)
+                self.size -= len(evicted_data)
+                evicted.append((evicted_key, evicted_data))
+
+        if self.directory:
+            for evicted_key, evicted_data in evicted:
+                self.__spill(evicted_key, evicted_data)
+
+    def __spill(self, key, data):
+        filename = self.__spill_filename(key)
+        temporary_filename = filename + ".tmp"
+        with open(temporary_filename, "wb") as file:
+            file.write(data)
+        os.replace(temporary_filename, filename)
+
+        # Keep the spilled reports within max_disk_bytes, oldest first
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".report"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        disk_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if disk_bytes <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            disk_bytes -= size
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Collects the data of reports from the ledger. Rendering them (see report.py)
+needs Matplotlib, which takes long to import, so the bot itself only imports
+this module and leaves rendering to the report pool.
+"""
+
+import calendar
+import datetime
+
+from metrics import metrics
+from periods import day_start, month_start
+
+# Every figure of a report is drawn from aggregations of the ledger grouped by
+# these keys
+pivot_keys = ("user", "category")
+
+def period_panels(report_axe, today):
+    """
+    Returns the panels of a figure of a report as (title, from_time, to_time)
+    tuples, from_time being the first second of the panel and to_time the
+    first second after it. Panels reach up to the end of today at most.
+
+    Periods are "year" and "month" (the current ones), "per_month_of_year"
+    (every month of the current year), "last_days" (the last report_axe["days"]
+    days, 30 by default), "per_week" (the last report_axe["weeks"] weeks, 12 by
+    default) and "year_over_year" (the current year up to today and the same
+    part of the report_axe["years"] - 1 years before it, 2 years by default).
+    """
+
+    period = report_axe["period"]
+    tomorrow = day_start(today + datetime.timedelta(days=1))
+
+    if period == "year":
+        return [("default", month_start(today.year, 1), tomorrow)]
+    elif period == "month":
+        return [("default", month_start(today.year, today.month), tomorrow)]
+    elif period == "per_month_of_year":
+        return [(datetime.date(today.year, month, 1).strftime("%b"), month_start(today.year, month),
+                 month_start(today.year, month + 1)) for month in range(1, 13)]
+    elif period == "last_days":
+        days = report_axe.get("days", 30)
+        return [("Letzte {} Tage".format(days), day_start(today - datetime.timedelta(days=days - 1)), tomorrow)]
+    elif period == "per_week":
+        monday = today - datetime.timedelta(days=today.weekday())
+        panels = []
+        for week in reversed(range(report_axe.get("weeks", 12))):
+            week_start = monday - datetime.timedelta(weeks=week)
+            panels.append(("KW {}".format(week_start.isocalendar()[1]), day_start(week_start),
+                           day_start(week_start + datetime.timedelta(weeks=1))))
+        return panels
+    elif period == "year_over_year":
+        panels = []
+        for year in range(today.year - report_axe.get("years", 2) + 1, today.year + 1):
+            # Years without the 29th of February end on the 28th
+            day = datetime.date(year, today.month, min(today.day, calendar.monthrange(year, today.month)[1]))
+            panels.append(("{}".format(year), month_start(year, 1), day_start(day + datetime.timedelta(days=1))))
+        return panels
+
+    raise ValueError("Unknown period {}".format(period))
+
+class PrefixSums:
+    """
+    Expenses made for one recipient between any two of a set of boundary
+    times, grouped by pivot_keys.
+
+    The ledger is aggregated once for every interval between two consecutive
+    boundaries and these pivots are summed up into prefix sums: the pivot of
+    boundary i holds everything from the first boundary up to boundary i. The
+    pivot between two boundaries is the difference of their prefix sums, so
+    every transaction is only aggregated once no matter how many (overlapping)
+    panels of a report need it.
+    """
+
+    def __init__(self, ledger, recipient, boundaries):
+        self.boundaries = sorted(set(boundaries))
+        self.positions = {boundary: i for i, boundary in enumerate(self.boundaries)}
+        self.prefix_sums = [dict()]
+        for start, end in zip(self.boundaries, self.boundaries[1:]):
+            prefix_sum = dict(self.prefix_sums[-1])
+            # Both times of group_by are exclusive
+            for group, value in ledger.group_by(pivot_keys, start - 1, end, recipient).items():
+                prefix_sum[group] = prefix_sum.get(group, .0) + value
+            self.prefix_sums.append(prefix_sum)
+
+    def between(self, from_time, to_time):
+        """
+        Returns the pivot (like Ledger.group_by) of the expenses from from_time
+        up to (but excluding) to_time, both of which have to be boundaries.
+        """
+
+        start = self.prefix_sums[self.positions[from_time]]
+        end = self.prefix_sums[self.positions[to_time]]
+
+        # Groups without expenses in between did not change at all
+        return {group: value - start.get(group, .0) for group, value in end.items() if value != start.get(group)}
+
+@metrics.timed("report_collect_seconds", "Time to collect the data of a report from the ledger")
+def collect_report_data(type, user, ledger, config, today=None):
+    """
+    Aggregates everything a report of the given type for the specified user
+    needs from the ledger (or a snapshot of it, see Ledger.snapshot). The
+    result only consists of plain dicts, lists and tuples, so it can be handed
+    to ReportRenderer.render in another process.
+
+    For every figure of the report it contains a list of (title, pivot) panels
+    (e.g. one panel per month for figures showing every month of the year, see
+    period_panels). All panels for the same recipient are taken from one set
+    of PrefixSums.
+    """
+
+    if today is None:
+        today = datetime.date.today()
+
+    snapshot = {
+        "type": type,
+        "today": today,
+        "figures": []
+    }
+
+    figures = []
+    boundaries = dict()
+    for report_axe in config[type + "_report"]["figures"]:
+        recipient = report_axe["recipient"]
+        if recipient == "user":
+            recipient = user
+
+        panels = period_panels(report_axe, today)
+        figures.append((recipient, panels))
+        for _, from_time, to_time in panels:
+            boundaries.setdefault(recipient, set()).update((from_time, to_time))
+
+    prefix_sums = {recipient: PrefixSums(ledger, recipient, recipient_boundaries)
+                   for recipient, recipient_boundaries in boundaries.items()}
+    for recipient, panels in figures:
+        snapshot["figures"].append([(title, prefix_sums[recipient].between(from_time, to_time))
+                                    for title, from_time, to_time in panels])
+
+    return snapshot
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# Renderer of a worker process, created once when the worker is started
+worker_renderer = None
+# Renderers for the configurations of households, the most recently used ones
+# are kept
+household_renderers = OrderedDict()
+max_household_renderers = 16
+
+def initialize_worker(config):
+    global worker_renderer
+    # Only the workers import Matplotlib (through report)
+    from report import renderer_from_config
+    worker_renderer = renderer_from_config(config)
+
+def household_renderer(config):
+    from report import renderer_from_config
+
+    key = json.dumps(config, sort_keys=True, default=str)
+    renderer = household_renderers.get(key)
+    if renderer is None:
+        renderer = renderer_from_config(config)
+        household_renderers[key] = renderer
+        if len(household_renderers) > max_household_renderers:
+            household_renderers.popitem(last=False)
+    household_renderers.move_to_end(key)
+
+    return renderer
+
+def render_in_worker(snapshot, config=None):
+    renderer = worker_renderer if config is None else household_renderer(config)
+    return renderer.render(snapshot)
+
+def warm_up_worker():
+    worker_renderer.warm_up()
+
+class ReportPool:
+    """
+    Renders reports in a pool of worker processes, so that Matplotlib neither
+    blocks the threads handling Telegram updates nor has its global state shared
+    between reports rendered at the same time. Several reports are rendered in
+    parallel, by at most workers processes (default_workers unless given, but
+    never more than there are processors). Every worker holds Matplotlib in
+    memory, so the default stays small for small machines.
+
+    Every worker sets up a report.ReportRenderer once, receives the data
+    collected by report_data.collect_report_data and returns the rendered
+    report as bytes.
+
+    Workers are only started when reports are submitted (one more whenever
+    all of them are busy) or when the pool is warmed up, so Matplotlib never
+    slows down starting the bot.
+
+    If a worker dies (e.g. killed for running out of memory) the reports it
+    was rendering fail and the pool is started anew for the next report.
+    """
+
+    default_workers = 2
+
+    def __init__(self, config, workers=None):
+        self.config = config
+        self.workers = workers or min(self.default_workers, os.cpu_count() or 1)
+        self.lock = threading.Lock()
+        self.executor = self.__new_executor()
+
+    def __new_executor(self):
+        # Forking a process with running threads (the bot, the job queue) is
+        # unsafe, so workers are started fresh
+        context = multiprocessing.get_context("spawn")
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context,
+                                   initializer=initialize_worker, initargs=(self.config,))
+
+    def __submit(self, function, *args):
+        with self.lock:
+            executor = self.executor
+        try:
+            return executor.submit(function, *args)
+        except BrokenProcessPool:
+            with self.lock:
+                # Unless another thread has replaced it already
+                if self.executor is executor:
+                    logger.warning("A report worker died, starting the report pool anew")
+                    executor.shutdown(wait=False)
+                    self.executor = self.__new_executor()
+                executor = self.executor
+            return executor.submit(function, *args)
+
+    def warm_up(self):
+        """
+        Starts a worker in the background and lets it render something once,
+        so that the first report does not have to wait for Matplotlib to be
+        imported and set up. Further workers are started once reports are
+        rendered in parallel.
+        """
+
+        self.__submit(warm_up_worker)
+
+    def submit(self, snapshot, config=None):
+        """
+        Starts rendering a report and returns a concurrent.futures.Future for
+        its bytes. Reports of households are rendered with the configuration of
+        the household instead of the one of the pool.
+        """
+
+        return self.__submit(render_in_worker, snapshot, config)
+
+    def shutdown(self):
+        with self.lock:
+            executor = self.executor
+        executor.shutdown()
@@ -1,130 +1,322 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import timeit
+# Startup is measured from here until the bot starts polling
+started = timeit.default_timer()
+
 import logging
+from contextlib import contextmanager
 from functools import wraps
 from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputMediaPhoto
+from telegram import InlineKeyboardMarkup, InputMediaPhoto, InputMediaDocument
 import yaml
 import re
+import io
+import datetime
+import tempfile
 from datetime import time
 import pytz
-from shutil import copyfile
 
-from ledger import Ledger
-from report import generate_report
+from balance import tolerance
+from households import Households
+from metrics import metrics
+from periods import month_start
+from report_data import collect_report_data
+from report_cache import ReportCache, report_cache_key
+from report_pool import ReportPool
+from concurrent.futures import Future, ThreadPoolExecutor
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-config = yaml.safe_load(open("configuration.yaml"))
-ledger = Ledger(config["ledger_file"])
-list_of_users = []
-for user_data in config["users"].values():
-    if "telegram_id" in user_data:
-        list_of_users.append(user_data["telegram_id"])
+# Set up by set_up() and not when this module is imported, because the worker
+# processes of the report pool import it again
+config = None
+households = None
+report_cache = None
+report_pool = None
 
-def set_up_keyboard(categories, prefix):
+def set_up(configuration_file="configuration.yaml"):
     """
-    Given a dict of categories creates a Telegram keyboard (e.g. an input method
-    with a button for each category) and returns it. The callback data of the
-    Telegram keyboard is set as prefix + ":" + the category name.
-    
-    Each category should contain a dict that further specifies that category.
-    For the keyboard the "display_name" and "emoji_name" properties are used as
-    the label for the buttons in the keyboard.
+    Loads the configuration and sets up the households (see Households) and
+    everything else the bot functions need.
     """
 
-    keyboard = []
+    global config, households, report_cache, report_pool
+
+    config = yaml.safe_load(open(configuration_file))
+    households = Households(config)
+    # Without several households the only one stays open all the time, so its
+    # ledger is loaded right away as before
+    if len(households.names) == 1:
+        households.release(households.acquire(households.names[0]))
+    report_cache = ReportCache(**config.get("report_cache", dict()))
+    report_pool = ReportPool(config, config.get("report_workers"))
 
-    row = []
-    for category, data in categories.items():
-        keyboard_text = "{} {}".format(data.get("display_name", ""), data.get("emoji_name", ""))
-        row.append(InlineKeyboardButton(keyboard_text, callback_data=prefix+":"+category))
-        # Restrict keyboard to two columns so that the labels (ideally) won't be word-wrapped
-        if len(row) == 2:
-            keyboard.append(row)
-            row = []
+    metrics.gauge("households", "Number of households served by the bot").set(len(households.names))
+    metrics.gauge("households_open", "Number of households with an open ledger", households.open_count)
+    metrics.gauge("ledger_transactions", "Number of transactions in the ledgers of the open households",
+                  households.transactions)
 
-    if row:
-        keyboard.append(row)
+not_allowed_text = ('Du stehst leider nicht auf der Liste '
+                    'der Leute die mich benutzen dürfen! 😊')
 
-    return keyboard
+stats_not_allowed_text = 'Meine Statistiken dürfen leider nur Admins sehen! 😊'
+
+def household_name(update):
+    """
+    Returns the name of the household of the user of the update, or None
+    after telling the user that they are not allowed to use the bot.
+    """
 
-recipient_keyboard = set_up_keyboard(config["users"], "recipient")
-user_keyboard = set_up_keyboard(config["users"], "user")
-category_keyboard = set_up_keyboard(config["categories"], "category")
+    user_id = update.effective_user.id
+    name = households.find(user_id)
+    if name is None:
+        update.message.reply_text(not_allowed_text)
+        logger.info('Zugriff wurde untersagt für ' + str(user_id) + ' (' +
+                    update.effective_user.first_name + ')')
+    return name
 
 def restricted(func):
     """
     Function wrapper that should be used for all Telegram bot functions to
     restrict access to the bot to the users configured in the configuration.
+    The function is called with the household of the user as third argument.
     """
 
     @wraps(func)
     def wrapped(update, context, *args, **kwargs):
-        user_id = update.effective_user.id
-        if user_id not in list_of_users:
-            update.message.reply_text('Du stehst leider nicht auf der Liste '
-                                      'der Leute die mich benutzen dürfen! 😊')
-            logger.info('Zugriff wurde untersagt für ' + str(user_id) + ' (' +
-                        update.effective_user.first_name + ')')
+        name = household_name(update)
+        if name is None:
+            return
+        with households.use(name) as household:
+            return func(update, context, household, *args, **kwargs)
+    return wrapped
+
+def authorized(func):
+    """
+    Like restricted, but for Telegram bot functions that do not need the
+    household of the user. Its ledger is therefore not opened.
+    """
+
+    @wraps(func)
+    def wrapped(update, context, *args, **kwargs):
+        if household_name(update) is None:
             return
         return func(update, context, *args, **kwargs)
     return wrapped
 
+start_text = ('Hi! Ich bin der Shopping Bot und kümmer mich darum '
+              'den Überblick über die Finanzen zu behalten! 🛒📃'
+              '\n'
+              'Wenn du wissen willst, was ich machen kann, gib '
+              'einfach den Befehl /help ein 😊')
+
+help_text = ('Wenn du mir schreibst, wer für was wieviel ausgegeben hat '
+             'speicher ich dies und schicke euch am Ende von jedem Monat '
+             'eine Auswertung! 📊'
+             '\n'
+             'Mit /balance zeige ich dir, wer wem wie viel schuldet. 💶')
+
 def start(update, context):
-    update.message.reply_text('Hi! Ich bin der Shopping Bot und kümmer mich darum '
-                              'den Überblick über die Finanzen zu behalten! 🛒📃'
-                              '\n'
-                              'Wenn du wissen willst, was ich machen kann, gib '
-                              'einfach den Befehl /help ein 😊')
+    update.message.reply_text(start_text)
 
-@restricted
+@authorized
 def help(update, context):
-    update.message.reply_text('Wenn du mir schreibst, wer für was wieviel ausgegeben hat '
-                              'speicher ich dies und schicke euch am Ende von jedem Monat '
-                              'eine Auswertung! 📊')
+    update.message.reply_text(help_text)
 
-def create_report(user, bot):
-    buffer_personal_report = generate_report("personal", user, ledger, config)
-    buffer_common_report = generate_report("common", user, ledger, config)
+def submit_report(household, type, user):
+    """
+    Returns a future for the report of the given type for user (as bytes). The
+    data for the report is collected from the ledger of the household right
+    away, but unless it is in the report cache the report is rendered by the
+    report pool.
+    """
 
-    bot.send_media_group(config["users"][user]["telegram_id"],
-                         [InputMediaPhoto(buffer_personal_report),
-                          InputMediaPhoto(buffer_common_report)])
+    # Entries made in the meantime must neither end up in a report cached
+    # under an older generation nor in only some of its figures
+    with household.ledger.snapshot() as snapshot:
+        key = report_cache_key(household.name, type, user, snapshot.generation, household.config,
+                               datetime.date.today())
+        data = report_cache.get(key)
+        if data is not None:
+            metrics.counter("report_cache_hits_total", "Reports served from the report cache").inc()
+            future = Future()
+            future.set_result(data)
+            return future
+
+        report_data = collect_report_data(type, user, snapshot, household.config)
+
+    submitted = datetime.datetime.now()
+    def cache_report(future):
+        metrics.histogram("report_render_seconds", "Time from submitting a report to the report pool until it is "
+                          "rendered").observe((datetime.datetime.now() - submitted).total_seconds())
+        if future.exception() is None:
+            report_cache.put(key, future.result())
+
+    metrics.counter("report_cache_misses_total", "Reports that had to be rendered").inc()
+    # The pool is set up with the configuration of the bot, which is the one
+    # of the household unless there are several
+    future = report_pool.submit(report_data, None if household.config is config else household.config)
+    future.add_done_callback(cache_report)
+
+    return future
+
+def submit_reports(household, user):
+    """
+    Returns the futures of the personal and the common report of user, see
+    submit_report.
+    """
 
-    buffer_personal_report.close()
-    buffer_common_report.close()
+    return [submit_report(household, "personal", user), submit_report(household, "common", user)]
+
+def submit_monthly_reports(household):
+    """
+    Submits the reports of all users of the household at once, so that they
+    are rendered in parallel, and returns a dict mapping every user to the
+    futures of their reports (see submit_reports).
+    """
+
+    # Users for shared purchases (like "Common") have no one to send a report
+    # to
+    return {user: submit_reports(household, user)
+            for user, data in household.config["users"].items() if "telegram_id" in data}
+
+def users_of(household, telegram_id):
+    """
+    Returns the users of the household with telegram_id.
+    """
+
+    return [user for user, data in household.config["users"].items() if data.get("telegram_id") == telegram_id]
+
+def report_files(config, reports):
+    """
+    Returns how rendered reports (as bytes) of a household with the
+    configuration config are sent, "photo" or "document", and a list of
+    (filename, bytes) tuples of them.
+    """
+
+    format = config.get("report_format", "pdf")
+    media_type = "photo" if format in ("png", "jpg", "jpeg") else "document"
+
+    return media_type, [("report." + format, data) for data in reports]
+
+def send_reports(config, user, bot, futures):
+    """
+    Waits for the reports to be rendered and sends them to user (of the
+    household with the configuration config).
+    """
+
+    media_type, files = report_files(config, [future.result() for future in futures])
+    if media_type == "photo":
+        media = [InputMediaPhoto(io.BytesIO(data)) for filename, data in files]
+    else:
+        media = [InputMediaDocument(io.BytesIO(data), filename=filename) for filename, data in files]
+
+    bot.send_media_group(config["users"][user]["telegram_id"], media)
 
 @restricted
-def report(update, context):
-    user_name = ""
-    user_id = update.effective_user.id
-    for user, data in config["users"].items():
-        if data.get("telegram_id") == user_id:
-            user_name = user
-            create_report(user_name, context.bot)
+def report(update, context, household):
+    for user in users_of(household, update.effective_user.id):
+        send_reports(household.config, user, context.bot, submit_reports(household, user))
+
+def household_monthly_report(name, bot):
+    # The household is only kept open while the data of the reports is
+    # collected
+    with households.use(name) as household:
+        config = household.config
+        futures = submit_monthly_reports(household)
+
+    for user, user_futures in futures.items():
+        send_reports(config, user, bot, user_futures)
 
 def monthly_report(context):
-    for user in config["users"].keys():
-        create_report(user, context.bot)
+    # The households are handled in parallel, but never more of them than can
+    # be open at once
+    with ThreadPoolExecutor(max_workers=households.max_open, thread_name_prefix="MonthlyReport") as executor:
+        futures = [(name, executor.submit(household_monthly_report, name, context.bot)) for name in households.names]
+        for name, future in futures:
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Monthly report of household %s failed", name)
+
+# Periods that can be exported, either a month ("2021-03") or a year ("2021")
+export_period_pattern = re.compile(r"^([0-9]{4})(?:-([0-9]{1,2}))?$")
+
+export_usage_text = ("Ich kann dir die Einkäufe eines Monats (z.B. /export 2021-03) "
+                     "oder eines Jahres (z.B. /export 2021) schicken. 📅")
+
+def export_timeframe(args):
+    """
+    Returns the period given in the arguments of /export (the current month
+    if there are none) and its start and end time or None if it is invalid.
+    """
 
-def find_name_or_synonym_in_message(name, synonyms, message):
+    today = datetime.date.today()
+    period = args[0] if args else "{}-{:02d}".format(today.year, today.month)
+    match = export_period_pattern.match(period)
+    if not match or not 1 <= int(match.group(2) or 1) <= 12:
+        return None
+
+    year = int(match.group(1))
+    if match.group(2):
+        month = int(match.group(2))
+        return period, month_start(year, month), month_start(year, month + 1)
+
+    return period, month_start(year, 1), month_start(year + 1, 1)
+
+def export_to_file(household, file, from_time, to_time):
     """
-    Find either the name or one of the list of synonyms in message and return
-    the name if either of those is found or an empty string otherwise.
+    Exports the transactions of the household from from_time up to (but
+    excluding) to_time as CSV to the binary file and rewinds it.
     """
 
-    if name in message:
-        return name
-    else:
-        for synonym in synonyms:
-            if synonym in message:
-                return name
-    
-    return ""
+    text_file = io.TextIOWrapper(file, encoding="utf-8", newline="")
+    # Both times are exclusive
+    household.ledger.export(text_file, from_time - 1, to_time)
+    text_file.detach()
+    file.seek(0)
+
+@contextmanager
+def exported_file(household, args):
+    """
+    Context manager exporting the transactions of the household in the period
+    given in the arguments of /export (see export_timeframe) to a temporary
+    file. Yields the filename to send it as and the binary file, or None if
+    the period is invalid.
+    """
+
+    timeframe = export_timeframe(args)
+    if timeframe is None:
+        yield None
+        return
+
+    period, from_time, to_time = timeframe
+    with tempfile.TemporaryFile() as file:
+        export_to_file(household, file, from_time, to_time)
+        yield "ledger_{}.csv".format(period), file
+
+@restricted
+def export(update, context, household):
+    """
+    Sends all transactions of a month (e.g. "/export 2021-03"), of a year
+    (e.g. "/export 2021") or of the current month (just "/export") as a CSV
+    file. The file is written to a temporary file instead of memory.
+    """
+
+    with exported_file(household, context.args) as export:
+        if export is None:
+            update.message.reply_text(export_usage_text)
+            return
+
+        filename, file = export
+        context.bot.send_document(update.effective_chat.id, document=file, filename=filename)
+
+# Anything formatted like a monetary value
+value_pattern = re.compile(r"((?:[0-9]*[.,])?[0-9]+)")
 
 def is_information_missing(user_data):
     if user_data["recipient"] == "" or user_data["user"] == "" or user_data["category"] == "":
@@ -132,81 +324,108 @@ def is_information_missing(user_data):
     else:
         return False
 
-def get_next_missing_information(user_data):
+def get_next_missing_information(household, user_data):
     if user_data["recipient"] == "":
         text = "Mir fehlt noch die Information, für wen der Einkauf war?"
-        reply_markup = InlineKeyboardMarkup(recipient_keyboard)
+        reply_markup = InlineKeyboardMarkup(household.recipient_keyboard)
         return text, reply_markup
     elif user_data["user"] == "":
         text = "Jetzt musst du mir noch sagen, wer bezahlt hat:"
-        reply_markup = InlineKeyboardMarkup(user_keyboard)
+        reply_markup = InlineKeyboardMarkup(household.user_keyboard)
         return text, reply_markup
     elif user_data["category"] == "":
         text = "In welche Kategorie fällt der Einkauf?"
-        reply_markup = InlineKeyboardMarkup(category_keyboard)
+        reply_markup = InlineKeyboardMarkup(household.category_keyboard)
         return text, reply_markup
 
-def enter_expense(user_data):
-    ledger.enter(user_data["user"],
-                 user_data["value"],
-                 category=user_data["category"],
-                 recipient=user_data["recipient"],
-                 comment=user_data["comment"])
+def enter_expense(household, user_data):
+    # Returns once the expense is stored on disk
+    household.ledger_writer.enter(user_data["user"],
+                                  user_data["value"],
+                                  category=user_data["category"],
+                                  recipient=user_data["recipient"],
+                                  comment=user_data["comment"])
 
-@restricted
-def text_message(update, context):
+def read_expense(household, message, user_data):
     """
-    Every text message containing something that is formated like a monetary
-    value (e.g. "12", "5.70" or "500,99") is treated as a new ledger entry. If a
-    user name is recognized this is interpreted as the user who has payed and if
-    a category is recognized in the message it will be used as the category for
-    this expense. All missing information is requested using one of the Telegram
-    keyboards.
+    Reads a new expense of the household from a text message into user_data
+    (see text_message).
+    Returns the reply, the keyboard asking for missing information (or None)
+    and whether the expense is complete and can be entered.
     """
 
-    message = update.message.text
-    values = re.findall(r"((?:[0-9]*[.,])?[0-9]+)", message)
+    values = value_pattern.findall(message)
 
     if not values:
-        update.message.reply_text("Falls du einen Einkauf verbuchen wolltest, habe ich dich leider "
-                                  "nicht verstanden. 🤔")
-    else:
-        context.user_data["value"] = float(values[0].replace(',', '.'))
+        return ("Falls du einen Einkauf verbuchen wolltest, habe ich dich leider "
+                "nicht verstanden. 🤔"), None, False
+
+    user_data["value"] = float(values[0].replace(',', '.'))
+
+    user_data["comment"] = message
+
+    user_data["recipient"] = ""
+
+    user_data["user"] = household.user_matcher.find(message)
 
-        context.user_data["comment"] = message
+    user_data["category"] = household.category_matcher.find(message)
 
-        context.user_data["recipient"] = ""
+    reply = "Cool, ein neuer Einkauf, werde ich direkt verbuchen. 😊📝 "
 
-        context.user_data["user"] = ""
-        for user, data in config["users"].items():
-            if context.user_data["user"] == "":
-                user_name = find_name_or_synonym_in_message(user, data["synonyms"], message)
-                context.user_data["user"] = user_name
-            else:
-                break
+    if not is_information_missing(user_data):
+        return reply, None, True
 
-        context.user_data["category"] = ""
-        for category, data in config["categories"].items():
-            if context.user_data["category"] == "":
-                category_name = find_name_or_synonym_in_message(category, data["synonyms"], message)
-                context.user_data["category"] = category_name
-            else:
-                break
+    text, markup = get_next_missing_information(household, user_data)
+    return reply + text, markup, False
 
-        reply = "Cool, ein neuer Einkauf, werde ich direkt verbuchen. 😊📝 "
-        reply_markup = None
+# Map provided data for ledger entry (category, recipient or user) to the
+# section of the configuration containing the display name (to be used in
+# the reply by the bot)
+display_map = {
+    "category": "categories",
+    "recipient": "users",
+    "user": "users"
+}
+
+def read_choice(household, data, text, user_data):
+    """
+    Reads the callback data of a keyboard button (see callback_query) into
+    user_data. Returns the edited text of the message with the keyboard, the
+    keyboard asking for the next missing information (or None) and whether
+    the expense is complete and can be entered.
+    """
+
+    data = data.split(":")
+    user_data[data[0]] = data[1]
+    text += " " + household.config[display_map[data[0]]][data[1]]["display_name"] + ". "
+
+    if not is_information_missing(user_data):
+        return text, None, True
+
+    next_text, markup = get_next_missing_information(household, user_data)
+    return text + next_text, markup, False
+
+@restricted
+@metrics.timed("text_message_seconds", "Time to handle a text message (including entering the expense)")
+def text_message(update, context, household):
+    """
+    Every text message containing something that is formated like a monetary
+    value (e.g. "12", "5.70" or "500,99") is treated as a new ledger entry. If a
+    user name is recognized this is interpreted as the user who has payed and if
+    a category is recognized in the message it will be used as the category for
+    this expense. All missing information is requested using one of the Telegram
+    keyboards.
+    """
 
-        if not is_information_missing(context.user_data):
-            enter_expense(context.user_data)
-        else:
-            text, markup = get_next_missing_information(context.user_data)
-            reply = reply + text
-            reply_markup = markup
+    reply, reply_markup, complete = read_expense(household, update.message.text, context.user_data)
+    if complete:
+        enter_expense(household, context.user_data)
 
-        update.message.reply_text(reply, reply_markup=reply_markup)
+    update.message.reply_text(reply, reply_markup=reply_markup)
 
 @restricted
-def callback_query(update, context):
+@metrics.timed("callback_query_seconds", "Time to handle a keyboard callback (including entering the expense)")
+def callback_query(update, context, household):
     """
     Called every time we get callback data from one of the Telegram keyboards.
     So this is always data that is needed for a new ledger entry and was still
@@ -215,48 +434,100 @@ def callback_query(update, context):
     enter the new transaction into the ledger.
     """
 
-    # Map provided data for ledger entry (category, recipient or user) to the
-    # section of the configuration containing the display name (to be used in
-    # the reply by the bot)
-    display_map = {
-        "category": "categories",
-        "recipient": "users",
-        "user": "users"
-    }
-
     query = update.callback_query
     query.answer()
-    edit = query.message.text
-
-    data = query.data.split(":")
-    context.user_data[data[0]] = data[1]
-    edit += " " + config[display_map[data[0]]][data[1]]["display_name"] + ". "
-    reply_markup = None
 
-    if not is_information_missing(context.user_data):
-        enter_expense(context.user_data)
-    else:
-        text, markup = get_next_missing_information(context.user_data)
-        edit += text
-        reply_markup = markup
+    edit, reply_markup, complete = read_choice(household, query.data, query.message.text, context.user_data)
+    if complete:
+        enter_expense(household, context.user_data)
 
     query.edit_message_text(edit, reply_markup=reply_markup)
 
+def balance_text(household):
+    """
+    Returns what every user of the household is owed (or owes) and the
+    transfers that would settle it.
+    """
+
+    users = household.config["users"]
+    lines = ["Aktueller Stand 💶"]
+    for user, value in household.balances.balances().items():
+        # Avoid showing "-0.00 €"
+        value = value if abs(value) >= tolerance else 0
+        lines.append("{}: {:+.2f} €".format(users.get(user, dict()).get("display_name", user), value))
+
+    transfers = household.balances.transfers()
+    if not transfers:
+        lines.append("Alles ausgeglichen! 🎉")
+        return "\n".join(lines)
+
+    lines.append("")
+    lines.append("Zum Ausgleichen:")
+    for debtor, creditor, value in transfers:
+        lines.append("{} → {}: {:.2f} €".format(users.get(debtor, dict()).get("display_name", debtor),
+                                              users.get(creditor, dict()).get("display_name", creditor), value))
+
+    return "\n".join(lines)
+
+@restricted
+def balance(update, context, household):
+    """
+    Replies with the balances of the household and how to settle them. They
+    are kept up to date with every expense, so this does not depend on the
+    size of the ledger.
+    """
+
+    update.message.reply_text(balance_text(household))
+
+def stats_text(telegram_id):
+    """
+    Returns how often and how fast (p50 and p99) the bot did what it did since
+    it was started and how large the open ledgers are. These figures cover all
+    households, so only the admins of the bot get them.
+    """
+
+    if telegram_id not in config.get("admins", []):
+        return stats_not_allowed_text
+
+    return metrics.summary()
+
+@authorized
+def stats(update, context):
+    update.message.reply_text(stats_text(update.effective_user.id))
+
+def dump_metrics(context):
+    metrics.write(config["metrics"]["file"])
+
 def error(update, context):
     logger.warning('Update "%s" caused error "%s"', update, context.error)
 
 def rotate_db_backup(context):
-    copyfile(config["ledger_file"], config["ledger_file"] + ".backup")
+    # Households that are not open are backed up without opening them
+    for name in households.names:
+        households.backup(name, ".backup")
+
+def close_idle_households(context):
+    households.close_idle()
 
 def main():
+    set_up()
+
     updater = Updater(config["bot_token"], use_context=True)
 
     dispatcher = updater.dispatcher
     dispatcher.add_handler(CommandHandler('start', start))
     dispatcher.add_handler(CommandHandler('help', help))
-    dispatcher.add_handler(CommandHandler('report', report))
-    dispatcher.add_handler(MessageHandler(Filters.text, text_message))
-    dispatcher.add_handler(CallbackQueryHandler(callback_query))
+    # Reports are rendered by the report pool, but waiting for them should
+    # not block other updates
+    dispatcher.add_handler(CommandHandler('report', report, run_async=True))
+    dispatcher.add_handler(CommandHandler('export', export, run_async=True))
+    dispatcher.add_handler(CommandHandler('stats', stats))
+    # Opening the ledger of a household can take a while
+    dispatcher.add_handler(CommandHandler('balance', balance, run_async=True))
+    # Messages are handled in parallel, so that expenses entered at the same
+    # time can be written to the ledger together
+    dispatcher.add_handler(MessageHandler(Filters.text, text_message, run_async=True))
+    dispatcher.add_handler(CallbackQueryHandler(callback_query, run_async=True))
     dispatcher.add_error_handler(error)
 
     job_queue = updater.job_queue
@@ -269,9 +540,30 @@ def main():
     # Create a backup of the ledger each day and keep one backup
     job_queue.run_daily(rotate_db_backup,
                         time(hour=4, minute=0, tzinfo=pytz.timezone('Europe/Berlin')))
+    # Close the ledgers of households that are not used anymore
+    if households.max_idle is not None:
+        job_queue.run_repeating(close_idle_households, min(60, households.max_idle))
+
+    # Optionally expose the metrics to Prometheus, via HTTP or a file
+    metrics_config = config.get("metrics", dict())
+    if "port" in metrics_config:
+        metrics.serve(metrics_config["port"], metrics_config.get("address", ""))
+    if "file" in metrics_config:
+        job_queue.run_repeating(dump_metrics, metrics_config.get("interval", 60))
 
     updater.start_polling()
+    startup_seconds = timeit.default_timer() - started
+    metrics.gauge("startup_seconds", "Time from starting the bot until it was polling for updates").set(startup_seconds)
+    logger.info("Polling for updates %.2f s after start", startup_seconds)
+
+    # Reports are only needed at the end of the month or on request, the
+    # workers rendering them are started (and import Matplotlib) afterwards
+    if config.get("report_prewarm", True):
+        report_pool.warm_up()
+
     updater.idle()
+    report_pool.shutdown()
+    households.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
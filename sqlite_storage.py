@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import sys
+import threading
+
+from csv_storage import CSVStorage
+from metrics import metrics
+
+class SQLiteStorage:
+    """
+    Storage backend keeping the ledger in an SQLite database.
+
+    Nothing has to be loaded into memory at startup and new entries are single
+    inserts. The database runs in WAL mode, transactions are indexed by
+    recipient and time and all expenses are summarized by the database itself
+    with GROUP BY queries.
+
+    Entries are written by one connection at a time, while every query reads
+    from an SQLiteSnapshot. With WAL readers don't block the writer and the
+    writer doesn't block readers. Snapshots run on reader connections that
+    are kept open and reused (at most max_idle_readers of them are kept while
+    nobody uses them), so a query doesn't pay for connecting to the database.
+    """
+
+    max_idle_readers = 4
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS ledger (
+               user TEXT NOT NULL,
+               value REAL NOT NULL,
+               category TEXT NOT NULL,
+               time INTEGER NOT NULL,
+               recipient TEXT NOT NULL,
+               comment TEXT NOT NULL DEFAULT ''
+           )""",
+        "CREATE INDEX IF NOT EXISTS ledger_recipient_time ON ledger (recipient, time)",
+        "CREATE INDEX IF NOT EXISTS ledger_time ON ledger (time)"
+    ]
+
+    insert_statement = ("INSERT INTO ledger (user, value, category, time, recipient, comment) "
+                        "VALUES (?, ?, ?, ?, ?, ?)")
+
+    # SQL expressions for every key transactions can be grouped by
+    key_expressions = {
+        "user": "user",
+        "category": "category",
+        "recipient": "recipient",
+        "month": "strftime('%Y-%m', time, 'unixepoch', 'localtime')",
+        "year": "CAST(strftime('%Y', time, 'unixepoch', 'localtime') AS INTEGER)"
+    }
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Handlers of the bot run in different threads, so the connection used
+        # for writing is shared and every use of it is serialized. Queries use
+        # their own connections, see SQLiteSnapshot.
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        # Reader connections not used by a snapshot right now
+        self.idle_readers = []
+        self.readers_lock = threading.Lock()
+        self.closed = False
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            # Entries have to be on disk once they are confirmed, even if
+            # power is lost
+            self.connection.execute("PRAGMA synchronous=FULL")
+            with self.connection:
+                for statement in self.schema:
+                    self.connection.execute(statement)
+
+    def snapshot(self):
+        """
+        Returns an SQLiteSnapshot of all transactions entered so far, which has
+        to be closed after use (e.g. by using it in a with statement).
+        """
+
+        with self.readers_lock:
+            connection = self.idle_readers.pop() if self.idle_readers else None
+        if connection is None:
+            # Transactions are controlled explicitly
+            connection = sqlite3.connect(self.filename, isolation_level=None, check_same_thread=False)
+
+        return SQLiteSnapshot(connection, self.__release_reader)
+
+    def __release_reader(self, connection):
+        with self.readers_lock:
+            if not self.closed and len(self.idle_readers) < self.max_idle_readers:
+                self.idle_readers.append(connection)
+                return
+
+        connection.close()
+
+    def __len__(self):
+        with self.snapshot() as snapshot:
+            return len(snapshot)
+
+    @property
+    def generation(self):
+        with self.snapshot() as snapshot:
+            return snapshot.generation
+
+    def rows(self, from_time=None, to_time=None, recipient=None):
+        """
+        See SQLiteSnapshot.rows.
+        """
+
+        with self.snapshot() as snapshot:
+            yield from snapshot.rows(from_time, to_time, recipient)
+
+    def append(self, rows):
+        """
+        Enters rows (lists in the column order of CSVStorage.column_to_index,
+        from any iterable) into the ledger in one transaction. Returns the
+        generation of the ledger including them.
+        """
+
+        with self.lock, self.connection:
+            self.connection.executemany(self.insert_statement, self.__parameters(rows))
+            return self.connection.execute("SELECT MAX(rowid) FROM ledger").fetchone()[0]
+
+    def __parameters(self, rows):
+        for row in rows:
+            yield (row[0], row[1], row[2], int(row[3]), row[4], row[5])
+
+    def group_by(self, keys, from_time, to_time, recipient=None):
+        """
+        See Ledger.group_by.
+        """
+
+        with self.snapshot() as snapshot:
+            return snapshot.group_by(keys, from_time, to_time, recipient)
+
+    def backup(self, filename):
+        """
+        Copies the database to filename using SQLite's online backup.
+        """
+
+        target = sqlite3.connect(filename)
+        try:
+            with self.lock:
+                self.connection.backup(target)
+        finally:
+            target.close()
+
+    @staticmethod
+    def backup_files(filename, backup_filename):
+        """
+        Copies the database filename, which is not open, to backup_filename
+        using SQLite's online backup.
+        """
+
+        source = sqlite3.connect(filename)
+        try:
+            target = sqlite3.connect(backup_filename)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        with self.readers_lock:
+            self.closed = True
+            for connection in self.idle_readers:
+                connection.close()
+            self.idle_readers = []
+
+    def check(self, rows):
+        """
+        Every row can be entered, see CSVStorage.check.
+        """
+
+    def import_csv(self, filename):
+        """
+        Copies all transactions of a CSV ledger file (including the entries in
+        its journal and its sealed years) into the database.
+        """
+
+        # Migrating the ledger should not seal anything
+        csv_storage = CSVStorage(filename, seal_years=False)
+        try:
+            # Rows are inserted one by one while iterating, but in a single
+            # transaction
+            self.append(csv_storage.rows())
+        finally:
+            csv_storage.close()
+
+class SQLiteSnapshot:
+    """
+    Read transaction on a reader connection of an SQLiteStorage (without
+    automatic transactions): all queries of a snapshot see the ledger as it
+    was when the snapshot was taken, no matter what is entered in the
+    meantime. Once the snapshot is closed the connection is handed back with
+    release(connection).
+    """
+
+    def __init__(self, connection, release):
+        self.connection = connection
+        self.release = release
+        self.connection.execute("BEGIN")
+        # The read transaction only starts with the first read. The highest
+        # rowid is looked up in the index of the table, counting the rows
+        # (which reads all of them) is left to __len__.
+        self.rowid = self.connection.execute("SELECT MAX(rowid) FROM ledger").fetchone()[0] or 0
+        self.count = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self.connection:
+            self.connection.execute("COMMIT")
+            self.release(self.connection)
+            self.connection = None
+
+    def __len__(self):
+        if self.count is None:
+            self.count = self.connection.execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+
+        return self.count
+
+    @property
+    def generation(self):
+        # Transactions are only ever inserted, so the highest rowid identifies
+        # the content of the ledger
+        return self.rowid
+
+    def rows(self, from_time=None, to_time=None, recipient=None):
+        """
+        Iterates over all transactions (ordered by time) as lists in the column
+        order of CSVStorage.column_to_index, optionally only those between
+        from_time and to_time (both exclusive) and those made for recipient.
+        Rows are fetched from the database while iterating.
+        """
+
+        conditions = []
+        parameters = []
+        if from_time is not None:
+            conditions.append("time > ?")
+            parameters.append(from_time)
+        if to_time is not None:
+            conditions.append("time < ?")
+            parameters.append(to_time)
+        if recipient is not None:
+            conditions.append("recipient = ?")
+            parameters.append(recipient)
+
+        query = "SELECT user, value, category, time, recipient, comment FROM ledger"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY time, rowid"
+
+        for row in self.connection.execute(query, parameters):
+            yield list(row)
+
+    @metrics.timed("ledger_group_by_seconds", "Time to summarize expenses (also per category or user)")
+    def group_by(self, keys, from_time, to_time, recipient=None):
+        """
+        See Ledger.group_by.
+        """
+
+        expressions = [SQLiteStorage.key_expressions[key] for key in keys]
+        query = "SELECT {}SUM(value) FROM ledger WHERE time > ? AND time < ?".format(
+            "".join(expression + ", " for expression in expressions))
+        parameters = [from_time, to_time]
+        if recipient is not None:
+            query += " AND recipient = ?"
+            parameters.append(recipient)
+        if expressions:
+            query += " GROUP BY " + ", ".join(expressions)
+
+        result = dict()
+        for row in self.connection.execute(query, parameters):
+            # Without any keys the sum is NULL if there are no transactions
+            if row[-1] is None:
+                continue
+            group = list(row[:-1])
+            for i, key in enumerate(keys):
+                if key == "month":
+                    year, month = group[i].split("-")
+                    group[i] = (int(year), int(month))
+            result[tuple(group)] = row[-1]
+
+        return result
+
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: {} CSV_LEDGER_FILE SQLITE_LEDGER_FILE".format(sys.argv[0]))
+        print("Migrates a CSV ledger file into a (new) SQLite database.")
+        sys.exit(1)
+
+    storage = SQLiteStorage(sys.argv[2])
+    if len(storage) > 0:
+        print("{} already contains transactions, not importing anything.".format(sys.argv[2]))
+        sys.exit(1)
+
+    storage.import_csv(sys.argv[1])
+    print("Imported {} transactions into {}.".format(len(storage), sys.argv[2]))
+    storage.close()
+
+if __name__ == '__main__':
+    main()